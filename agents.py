@@ -4,26 +4,61 @@ Agent classes
 
 Contains agent classes which can be used in a model.
 
+SlottedAgent: compact agent base class without per-instance __dict__.
 Death: agent used after animal dies, used for visualization.
+DeathBuffer: ring buffer of deaths used instead of Death agents in headless runs.
 Animal: base agent
 Prey: extension to Animal implementing step function for prey
 Predator: extension to Animal implementing step function for predators
-Grass: agent used for environment and food sourch prey.
+
+Grass is not an agent, but is stored in the GrassField of the model.
 """
 
-import random
 import numpy as np
 
-from mesa import Agent
-
 from utils import move_coordinates, heading_to_angle
 
 
-class Death(Agent):
+class SlottedAgent:
+    """Compact replacement of the Mesa Agent base class.
+
+    Attributes are stored in __slots__ instead of a per-instance __dict__,
+    which mesa.Agent always has. Provides the same interface, so it works
+    with the Mesa schedulers and spaces.
+    """
+
+    __slots__ = ('unique_id', 'model', 'pos', 'last_pos')
+
+    def __init__(self, unique_id, model):
+        """Create a new agent.
+
+        Args:
+            unique_id (int): A unique identifier for the agent
+            model (Model): Instance of the model which contains the agent.
+        """
+        self.unique_id = unique_id
+        self.model = model
+        self.pos = None
+
+    def step(self):
+        """A single step of the agent. """
+        pass
+
+    def advance(self):
+        pass
+
+    @property
+    def random(self):
+        return self.model.random
+
+
+class Death(SlottedAgent):
     """Death agent used after an animal has died.
     Only used for visualization purpose.
     """
 
+    __slots__ = ('animal_type', 'duration')
+
     def __init__(self, unique_id, model, pos, animal_type):
         """Create a new death agent.
 
@@ -47,9 +82,65 @@ class Death(Agent):
             self.model.remove_agent(self)
 
 
-class Animal(Agent):
+class DeathBuffer:
+    """Fixed-size ring buffer of death events, used instead of Death agents
+    when the model runs headless. Stores position, animal type and time step
+    of the most recent deaths.
+    """
+
+    animal_types = ('Prey', 'Predator')
+
+    def __init__(self, capacity=1000):
+        """Create an empty death buffer.
+
+        Args:
+            capacity (int): Maximum number of deaths stored.
+        """
+        self.capacity = capacity
+        self.count = 0
+        self.positions = np.empty((capacity, 2))
+        self.types = np.empty(capacity, dtype=np.int8)
+        self.steps = np.empty(capacity, dtype=int)
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, pos, animal_type, step):
+        """Add a death of animal_type at pos during time step. """
+        i = self.count % self.capacity
+        self.positions[i] = pos
+        self.types[i] = self.animal_types.index(animal_type)
+        self.steps[i] = step
+        self.count += 1
+
+    def extend(self, positions, animal_type, step):
+        """Add the deaths of animals of the same type at once. """
+        positions = np.asarray(positions).reshape(-1, 2)
+        n = len(positions)
+        # Only the last capacity deaths fit, the others are overwritten.
+        dropped = max(n - self.capacity, 0)
+        i = (self.count + dropped + np.arange(n - dropped)) % self.capacity
+        self.positions[i] = positions[dropped:]
+        self.types[i] = self.animal_types.index(animal_type)
+        self.steps[i] = step
+        self.count += n
+
+    def events(self, since=0):
+        """Yield (pos, animal_type, step) of stored deaths from time step
+        since onwards, oldest first.
+        """
+        for i in range(self.count - len(self), self.count):
+            i %= self.capacity
+            if self.steps[i] >= since:
+                yield (tuple(self.positions[i]),
+                       self.animal_types[self.types[i]], self.steps[i])
+
+
+class Animal(SlottedAgent):
     """Animal base class. """
 
+    __slots__ = ('_energy',)
+
     def __init__(self, unique_id, model, pos):
         """Create a new animal agent.
 
@@ -60,6 +151,24 @@ class Animal(Agent):
         """
         super().__init__(unique_id, model)
         self.pos = pos
+        self._energy = 0
+
+    @property
+    def energy(self):
+        """Energy level of the animal. Changes are added to the total
+        energy of its species in the model.
+        """
+        return self._energy
+
+    @energy.setter
+    def energy(self, value):
+        self.model.total_energy[self.__class__.__name__] += value - self._energy
+        self._energy = value
+
+    @property
+    def random(self):
+        """Random number stream of the species of the animal. """
+        return self.model.random_streams[self.__class__.__name__]
 
     def directed_move(self, direction, distance=25):
         """Moves the animal towards a new position.
@@ -78,8 +187,8 @@ class Animal(Agent):
         Args:
             max_distance (float): max distance to be travelled.
         """
-        distance = random.uniform(0, max_distance)
-        direction = random.uniform(0, 360)
+        distance = self.random.uniform(0, max_distance)
+        direction = self.random.uniform(0, 360)
         self.directed_move(direction, distance)
 
     def reproduce(self):
@@ -87,8 +196,8 @@ class Animal(Agent):
         self.model.new_agent(self.__class__, self.pos)
 
     def die(self):
-        """Removes animal agent from the model and creates a new death agent. """
-        self.model.new_agent(Death, self.pos, self.__class__.__name__)
+        """Removes animal agent from the model and records its death. """
+        self.model.record_death(self.pos, self.__class__.__name__)
         self.model.remove_agent(self)
 
     def get_neighbors(self, radius, agent_type=None):
@@ -104,7 +213,7 @@ class Animal(Agent):
         else:
             return self.model.space.get_agent_neighbors(self.pos, agent_type, radius)
 
-    def get_vector(self, agent_type, radius=25, grass=False):
+    def get_vector(self, agent_type, radius=25):
         """Return mean vector of all agents of agent_type within distance
         of the agent.
 
@@ -112,10 +221,6 @@ class Animal(Agent):
             agent_type (Agent): agent type to match.
             radius (float): get all agents within this distance of the center.
         """
-        if grass:
-            agents = self.get_neighbors(radius, agent_type)
-            fully_grown = [agent for agent in agents if agent.fully_grown]
-            return self.model.space.get_heading_to_agents(self.pos, fully_grown)
         return self.model.space.get_vector_to_agents(self.pos, agent_type, radius)
 
 
@@ -124,6 +229,8 @@ class Prey(Animal):
     immitate prey animals.
     """
 
+    __slots__ = ()
+
     def __init__(self, unique_id, model, pos):
         """Create a new Prey agent.
 
@@ -135,9 +242,10 @@ class Prey(Animal):
         super().__init__(unique_id, model, pos)
         self.energy = 2*self.model.prey_gain_from_food
 
-    def step(self):
-        """Perform a single time step for prey agent. """
-
+    def flock_vector(self):
+        """Return the sum of the separation and coherence vectors of the prey,
+        multiplied with their specific factors.
+        """
         # Seperate vector from other prey.
         seperate_vector_prey = self.get_vector(Prey, self.model.prey_reach)
 
@@ -148,22 +256,38 @@ class Prey(Animal):
         # Coherence vector towards other prey.
         cohere_vector = self.get_vector(Prey, self.model.prey_sight)
 
-        fully_grown_grass = [grass for grass in self.get_neighbors(
-            self.model.prey_reach, Grass) if grass.fully_grown]
+        return \
+            -1 * self.model.prey_separate_factor * seperate_vector_prey + \
+            -1 * self.model.prey_separate_predators_factor * seperate_vector_predators + \
+            self.model.prey_cohere_factor * cohere_vector
+
+    def step(self):
+        """Perform a single time step for prey agent. """
+        if self.model.prey_food is not None:
+            # Already moved by the model, see PreyPredatorModel.move_prey.
+            fully_grown_grass = self.model.prey_food[self]
+            fully_grown_grass = fully_grown_grass[
+                self.model.grass.fully_grown[fully_grown_grass]]
+        else:
+            fully_grown_grass = self.model.grass.grown_within(
+                self.pos, self.model.prey_reach)
+            self.move(fully_grown_grass)
+        self.feed(fully_grown_grass)
+
+    def move(self, fully_grown_grass):
+        """Move towards the flock and, when hungry, towards grass. """
 
         # Food vector towards grass which is fully grown.
         # Zero when already on grass or energy level sufficiently high.
-        if self.energy < self.model.prey_food_search_max and not fully_grown_grass:
-            hungry_vector = self.get_vector(Grass, self.model.prey_sight, True)
+        if self.energy < self.model.prey_food_search_max and not len(fully_grown_grass):
+            hungry_vector = self.model.grass.heading_to_grown(
+                self.pos, self.model.prey_sight)
         else:
             hungry_vector = np.zeros(2)
 
-        # Result vecor calculated from the four vectors calculated above,
-        # multiplied with specific factors.
-        result_vector = \
-            -1 * self.model.prey_separate_factor * seperate_vector_prey + \
-            -1 * self.model.prey_separate_predators_factor * seperate_vector_predators + \
-            self.model.prey_cohere_factor * cohere_vector + \
+        # Result vecor calculated from the flocking vectors and the food
+        # vector, multiplied with specific factors.
+        result_vector = self.flock_vector() + \
             self.model.prey_hungry_factor * hungry_vector
 
         # Move randomly when result vector is zero.
@@ -174,8 +298,10 @@ class Prey(Animal):
             self.directed_move(heading_to_angle(result_vector[0],
                                                 result_vector[1]))
 
+    def feed(self, fully_grown_grass):
+        """Reproduce, eat one of the patches of fully_grown_grass and die. """
         # Reproduce randomly when energy level is sufficient.
-        if self.energy > self.model.prey_reproduction_min and random.random() < self.model.prey_reproduction_chance:
+        if self.energy > self.model.prey_reproduction_min and self.random.random() < self.model.prey_reproduction_chance:
             self.reproduce()
 
         self.energy -= 1
@@ -183,10 +309,10 @@ class Prey(Animal):
         # If present, eat one patch of fully grown grass.
         if len(fully_grown_grass) > 0:
             self.energy += self.model.prey_gain_from_food
-            random.choice(fully_grown_grass).eaten()
+            self.model.grass.eat(self.random.choice(fully_grown_grass))
 
         # Die randomly or when energy level lower than zero.
-        if self.energy < 0 or random.random() < self.model.prey_death_chance:
+        if self.energy < 0 or self.random.random() < self.model.prey_death_chance:
             self.die()
 
 
@@ -195,6 +321,8 @@ class Predator(Animal):
     immitate predator animals.
     """
 
+    __slots__ = ()
+
     def __init__(self, unique_id, model, pos):
         """Create a new Predator agent.
 
@@ -223,52 +351,21 @@ class Predator(Animal):
 
         # Get list with prey on location with less than 5 other prey
         # surrounding it. Eat only first prey in the list.
+        # Prey counts are cached by the space for the whole step.
         prey_on_location = self.get_neighbors(self.model.predator_reach, Prey)
-        lonely_prey = filter(lambda p: len(p.get_neighbors(
-            self.model.predator_reach, Prey)) < 5, prey_on_location)
+        lonely_prey = filter(lambda p: self.model.space.count_neighbors(
+            p, self.model.predator_reach) < 5, prey_on_location)
         for prey in lonely_prey:
             prey.die()
             self.energy += self.model.predator_gain_from_food
             break
 
         # Reproduce randomly when energy level is sufficient.
-        if self.energy > self.model.predator_reproduction_min and random.random() < self.model.predator_reproduction_chance:
+        if self.energy > self.model.predator_reproduction_min and self.random.random() < self.model.predator_reproduction_chance:
             self.reproduce()
 
         self.energy -= 1
 
         # Die randomly or when energy level lower than zero.
-        if self.energy < 0 or random.random() < self.model.predator_death_chance:
+        if self.energy < 0 or self.random.random() < self.model.predator_death_chance:
             self.die()
-
-
-class Grass(Agent):
-    """ Grass class: agent designed to be eaten after which it will regrow. """
-
-    def __init__(self, unique_id, model, pos, fully_grown, countdown):
-        """Create one patch of grass.
-
-        Args:
-            unique_id (int): A unique identifier for the agent
-            model (Model): Instance of the model which contains the grass.
-            pos (float, float): Coordinate tuple of the position of the grass patch.
-            fully_grown (bool): Boolean if grass if fully grown.
-            countdown (int): Counter in how many timesteps grass will be fully grown.
-        """
-        super().__init__(unique_id, model)
-        self.fully_grown = fully_grown
-        self.countdown = countdown
-        self.pos = pos
-
-    def step(self):
-        """Perform a single time step for grass. """
-        if not self.fully_grown:
-            if self.countdown <= 0:
-                self.fully_grown = True
-                self.countdown = self.model.food_regrowth_time
-            else:
-                self.countdown -= 1
-
-    def eaten(self):
-        """Set grass to eaten. """
-        self.fully_grown = False
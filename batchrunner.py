@@ -1,30 +1,758 @@
 """
 The batchrunner class used in this project.
 
-Core class: SobolBatchRunner
+Core classes: SobolBatchRunner, ResultsStore, CostScheduler
 """
 
+from collections import defaultdict
+import heapq
+import json
+import os
+import time
+
+import numpy as np
 import pandas as pd
 
-from multiprocess import Pool, cpu_count
-from mesa.batchrunner import BatchRunnerMP
+from multiprocess import Pool, cpu_count, shared_memory
+from mesa.batchrunner import BatchRunner
+from SALib.analyze import sobol
 from SALib.sample import saltelli
+from tqdm import tqdm
+
+from ensemble import Ensemble
+from results import to_json
+from runcache import run_key, source_version
+
+
+# Points of the Sobol sequence skipped by every Saltelli sample. SALib skips
+# a number which depends on the sample size, after which the samples of
+# different sizes no longer start with the same points.
+SKIP_VALUES = 2 ** 12
+
+
+def run_seed(seed, sample, row, iteration):
+    """Returns the seed of a single run, derived from the batch seed, its
+    Saltelli sample, its row within the rows of that sample and its
+    iteration. None of these depend on the number of samples, so a run
+    gets the same seed in a batch run with more samples or iterations.
+    """
+    return int(np.random.SeedSequence(
+        [seed, sample, row, iteration]).generate_state(1)[0])
+
+
+class ResultsStore:
+    """Append-only store of the results of finished runs, one JSON line per
+    run, so an interrupted batch run can be resumed.
+
+    The first line holds the settings of the batch run. Every line is
+    flushed to disk before the next run is stored, so at most the last line
+    is lost in a crash; an incomplete last line is removed when loading.
+    """
+
+    def __init__(self, path, resume=False):
+        """Open a store.
+
+        Args:
+            path (str): Path of the file.
+            resume (bool): Load the runs in an existing file, instead of
+                overwriting it.
+        """
+        self.path = path
+        self.settings = None
+        self.runs = {}
+        self.seconds = {}
+        if resume and os.path.exists(path):
+            self._load()
+        else:
+            open(path, 'w').close()
+
+    def _load(self):
+        """Read the settings and runs, and remove an incomplete last line. """
+        end = 0
+        with open(self.path, 'rb') as in_file:
+            for line in in_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                end += len(line)
+                if self.settings is None:
+                    self.settings = record
+                else:
+                    self.runs[record['run']] = \
+                        (tuple(record['key']), record['values'])
+                    self.seconds[record['run']] = record.get('seconds')
+        with open(self.path, 'r+b') as in_file:
+            in_file.truncate(end)
+
+    def _write(self, record):
+        """Append a record as a line and make sure it is on disk. """
+        with open(self.path, 'a') as out_file:
+            out_file.write(json.dumps(record, default=to_json) + '\n')
+            out_file.flush()
+            os.fsync(out_file.fileno())
+
+    def open(self, settings):
+        """Write the settings of a new batch run, or check that they match
+        the settings of the batch run being resumed.
+        """
+        settings = json.loads(json.dumps(settings, default=to_json))
+        if self.settings is None:
+            self._write(settings)
+            self.settings = settings
+        elif self.settings != settings:
+            different = [name for name in settings
+                         if self.settings.get(name) != settings[name]]
+            raise ValueError(
+                f'Settings {", ".join(different)} of the batch run do not '
+                f'match the settings in {self.path}')
+
+    def append(self, run, key, values, seconds=None):
+        """Store the key, reporter values and run time of a finished run. """
+        self._write({'run': run, 'key': key, 'values': values,
+                     'seconds': seconds})
+        self.runs[run] = (tuple(key), values)
+        self.seconds[run] = seconds
+
+
+class CostScheduler:
+    """Hands out the tasks of a batch run in chunks, most expensive first.
+
+    The first task of every sample is run on its own, as a probe of the
+    cost of the sample. Probes are ordered by a quadratic least squares fit
+    of the log run time on the (scaled) parameters of the samples probed so
+    far. The remaining tasks of probed samples are ordered by the mean run
+    time of the sample and handed out in chunks which get smaller as less
+    work remains (guided scheduling), so the last tasks are spread over all
+    workers.
+    """
+
+    def __init__(self, samples, processes, chunks_per_process=4):
+        """Create a scheduler without tasks.
+
+        Args:
+            samples (ndarray): Parameter values of each sample (row).
+            processes (int): Number of workers.
+            chunks_per_process (int): The remaining work is divided in about
+                this many chunks per worker.
+        """
+        samples = np.asarray(samples, dtype=float).reshape(len(samples), -1)
+        span = np.ptp(samples, axis=0)
+        scaled = (samples - samples.min(axis=0)) / np.where(span > 0, span, 1)
+        self.features = np.hstack(
+            [np.ones((len(samples), 1)), scaled, scaled ** 2])
+        self.processes = processes
+        self.chunks_per_process = chunks_per_process
+
+        self.total = np.zeros(len(samples))
+        self.count = np.zeros(len(samples), dtype=int)
+        self.estimate = np.ones(len(samples))
+        self.fitted = 0
+
+        # Tasks per row, the lowest iteration last.
+        self.pending = defaultdict(list)
+        self.n = 0
+        self.unprobed = []
+        self.probing = set()
+        self.probed = []
+        self.started = False
+
+    def add(self, row, iteration, task):
+        """Add a task for the sample in row. """
+        self.pending[row].append((iteration, task))
+        self.n += 1
+
+    def observe(self, row, seconds):
+        """Record the run time of a finished task of the sample in row. """
+        if seconds is None:
+            return
+        self.total[row] += seconds
+        self.count[row] += 1
+        self.estimate[row] = self.total[row] / self.count[row]
+        if row in self.probing:
+            self.probing.remove(row)
+            if self.pending[row]:
+                heapq.heappush(self.probed, (-self.estimate[row], row))
+        observed = int(np.count_nonzero(self.count))
+        # Refit less often as observations accumulate.
+        if observed - self.fitted >= max(self.processes, self.fitted // 20):
+            self.fit()
+
+    def fit(self):
+        """Update the predicted cost of the samples which are not probed. """
+        observed = self.count > 0
+        self.fitted = int(np.count_nonzero(observed))
+        means = self.total[observed] / self.count[observed]
+        if self.fitted > self.features.shape[1]:
+            coefficients = np.linalg.lstsq(
+                self.features[observed], np.log(np.maximum(means, 1e-6)),
+                rcond=None)[0]
+            self.estimate = np.exp(self.features @ coefficients)
+        else:
+            self.estimate = np.full(len(self.estimate), means.mean())
+        self.estimate[observed] = means
+        if self.started:
+            self.unprobed.sort(key=lambda row: self.estimate[row])
+
+    def start(self):
+        """Sort the tasks once all tasks are added. """
+        for row, tasks in self.pending.items():
+            tasks.sort(reverse=True)
+            if self.count[row]:
+                heapq.heappush(self.probed, (-self.estimate[row], row))
+            else:
+                self.unprobed.append(row)
+        self.unprobed.sort(key=lambda row: self.estimate[row])
+        self.started = True
+
+    def requeue(self, row, iteration, task):
+        """Hand out a task again, for instance when its worker died. """
+        if not self.started:
+            self.add(row, iteration, task)
+            return
+        self.pending[row].append((iteration, task))
+        self.pending[row].sort(reverse=True)
+        self.n += 1
+        if self.count[row]:
+            heapq.heappush(self.probed, (-self.estimate[row], row))
+        elif row in self.probing:
+            # The probe was lost, probe the sample again.
+            self.probing.remove(row)
+            self.unprobed.append(row)
+
+    def __len__(self):
+        """Returns the number of tasks not handed out yet. """
+        return self.n
+
+    def pop(self, row):
+        """Returns the next task of the sample in row. """
+        self.n -= 1
+        return self.pending[row].pop()[1]
+
+    def next_chunk(self):
+        """Returns the next tasks to run in one chunk. """
+        if not self.started:
+            self.start()
+
+        if self.unprobed:
+            row = self.unprobed.pop()
+            self.probing.add(row)
+            return [self.pop(row)]
+
+        while self.probed and not self.pending[self.probed[0][1]]:
+            heapq.heappop(self.probed)
+
+        if not self.probed:
+            # Only tasks of samples which are still being probed are left.
+            row = max((row for row in self.probing if self.pending[row]),
+                      key=lambda row: self.estimate[row])
+            return [self.pop(row)]
+
+        remaining = sum(self.estimate[row] * len(self.pending[row])
+                        for row in {row for _, row in self.probed})
+        target = remaining / (self.chunks_per_process * self.processes)
+        chunk, cost = [], 0
+        while self.probed and (not chunk or cost < target):
+            row = self.probed[0][1]
+            if not self.pending[row]:
+                # Done, or a duplicate entry of a requeued sample.
+                heapq.heappop(self.probed)
+                continue
+            chunk.append(self.pop(row))
+            cost += self.estimate[row]
+        return chunk
+
+
+# State of a worker process, set by init_worker.
+worker = {}
+
+
+def attach_worker(model_cls, matrix_name, shape, *args):
+    """Initializer of the worker processes. Attaches to the shared matrix
+    of parameter values and initializes the worker with it.
+    """
+    matrix = shared_memory.SharedMemory(name=matrix_name)
+    init_worker(model_cls, np.ndarray(shape, dtype=np.float64, buffer=matrix.buf),
+                *args)
+    worker['matrix'] = matrix
+
+
+def init_worker(model_cls, param_values, names, fixed_parameters, seed,
+                block, common_random_numbers, max_steps, model_reporters):
+    """Stores what is needed to run any task in the worker. """
+    worker.update(
+        param_values=param_values,
+        model_cls=model_cls,
+        names=names,
+        fixed_parameters=fixed_parameters,
+        seed=seed,
+        block=block,
+        common_random_numbers=common_random_numbers,
+        max_steps=max_steps,
+        model_reporters=model_reporters,
+        dtype=record_dtype(model_reporters),
+    )
+
+
+def record_dtype(model_reporters):
+    """Returns the dtype of the fixed-width result record of a run. """
+    return np.dtype([('run', np.int64), ('seconds', np.float64),
+                     ('pid', np.int64)] +
+                    [(name, np.float64) for name in model_reporters])
+
+
+def run_kwargs(names, values, fixed_parameters, seed, block,
+               common_random_numbers, row, iteration):
+    """Returns the keyword arguments of the model for an iteration of a
+    row of the parameter values, in which every Saltelli sample has block
+    consecutive rows. With common_random_numbers, the rows of a sample
+    share their seed.
+    """
+    kwargs = dict(zip(names, values))
+    kwargs.update(fixed_parameters)
+    sample, offset = divmod(row, block)
+    if common_random_numbers:
+        offset = 0
+    kwargs['seed'] = run_seed(seed, sample, offset, iteration)
+    return kwargs
+
+
+def task_iterations(task):
+    """Returns the iterations of a (row, iteration) task, or of a (row,
+    iterations) task which runs a tuple of iterations as an Ensemble.
+    """
+    iterations = task[1]
+    return iterations if isinstance(iterations, tuple) else (iterations,)
+
+
+def run_tasks(tasks):
+    """Run (row, iteration) tasks in a worker, on the parameter values of a
+    row of the shared matrix. Tasks with a tuple of iterations run them as
+    the replicas of an Ensemble, which share the run time equally.
 
+    Returns:
+        Bytes of one result record per run.
+    """
+    param_values = worker['param_values']
+    records = np.zeros(sum(len(task_iterations(task)) for task in tasks),
+                       dtype=worker['dtype'])
+    i = 0
+    for task in tasks:
+        start = time.perf_counter()
+        row = task[0]
+        iterations = task_iterations(task)
+        runs = [iteration * len(param_values) + row
+                for iteration in iterations]
+        kwargs = [run_kwargs(worker['names'], param_values[row],
+                             worker['fixed_parameters'], worker['seed'],
+                             worker['block'],
+                             worker['common_random_numbers'], row, iteration)
+                  for iteration in iterations]
+        if isinstance(task[1], tuple):
+            seeds = [model_kwargs.pop('seed') for model_kwargs in kwargs]
+            values = Ensemble(worker['model_cls'], seeds, **kwargs[0]).run(
+                worker['max_steps'], worker['model_reporters'])
+        else:
+            model = worker['model_cls'](**kwargs[0])
+            while model.running and model.schedule.steps < worker['max_steps']:
+                model.step()
+            values = [{name: reporter(model) for name, reporter
+                       in worker['model_reporters'].items()}]
+        seconds = (time.perf_counter() - start) / len(runs)
+        for run, run_values in zip(runs, values):
+            record = records[i]
+            for name, value in run_values.items():
+                record[name] = value
+            record['run'] = run
+            record['seconds'] = seconds
+            record['pid'] = os.getpid()
+            i += 1
+    return records.tobytes()
 
-class SobolBatchRunner(BatchRunnerMP):
-    """SobolBatchRunner: extend BatchRunnerMP to fix import and
+
+class SobolBatchRunner(BatchRunner):
+    """SobolBatchRunner: extend BatchRunner to run in parallel and
     use saltelli sample as variable parameters. """
 
-    def __init__(self, model_cls, problem, distinct_samples, **kwargs):
+    def __init__(self, model_cls, problem, distinct_samples, seed=None,
+                 store_path=None, resume=False,
+                 common_random_numbers=False, cache=None, ensemble=False,
+                 processes=None, **kwargs):
         """Create batchrunner with max amount of processors available.
-        Initialize the different parameter value combinations used in runner."""
+        Initialize the different parameter value combinations used in runner.
+
+        Every run gets its own seed, derived from seed, its Saltelli sample,
+        its row within the sample and its iteration, so the batch run is
+        reproducible. Without seed, a random seed is chosen, which is stored
+        in self.seed. The Saltelli samples skip SKIP_VALUES points of the
+        Sobol sequence, so the parameters and seeds of the runs of a batch
+        run recur in one with more distinct_samples or iterations, and can
+        be taken from a cache.
+
+        With common_random_numbers, all rows of the A, B and AB matrices
+        of a Saltelli sample share their seed in each iteration, so the
+        differences between them are caused by the parameters rather than
+        by noise. The seeds still differ between samples and iterations.
+
+        With store_path, the model reporters of every finished run are
+        appended to a ResultsStore. With resume, runs already in the store
+        are skipped and the seed is taken from the store.
+
+        With a runcache.RunCache, runs which are in the cache are not run
+        again, and finished runs are added to it.
+
+        With ensemble, the iterations of a sample run as the replicas of one
+        ensemble.Ensemble of vectorized models, instead of as separate runs.
+        Their results are statistically equal to separate vectorized runs,
+        but not exactly, so they are cached separately.
+
+        The runs are run by processes worker processes, by default one per
+        CPU.
+        """
         super().__init__(model_cls, **kwargs)
-        self.processes = cpu_count()
-        self.pool = Pool(self.processes)
+        self.store = None
+        if store_path is not None:
+            self.store = ResultsStore(store_path, resume)
+            if seed is None and self.store.settings is not None:
+                seed = self.store.settings['seed']
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        self.seed = seed
+        self.processes = processes or cpu_count()
+        self.cache = cache
+        self._version = source_version(model_cls) if cache is not None else None
+        self.ensemble = ensemble
+        if ensemble and self._version is not None:
+            self._version += '-ensemble'
 
-        param_values = saltelli.sample(problem, distinct_samples)
+        self.problem = problem
+        self.names = list(problem['names'])
+        self.distinct_samples = distinct_samples
+        param_values = saltelli.sample(problem, distinct_samples,
+                                       skip_values=SKIP_VALUES)
+        self.param_values = param_values
         self.parameters_list = [{name: val for name, val in zip(
-            problem['names'], vals)} for vals in param_values]
+            self.names, vals)} for vals in param_values]
+        self.common_random_numbers = common_random_numbers
+        # Number of consecutive rows of one Saltelli sample.
+        self.block = len(param_values) // distinct_samples
+
+        # Reporter values of every run, by run index.
+        runs = len(param_values) * self.iterations
+        self.results = np.full((runs, len(self.model_reporters)), np.nan)
+        self.finished = np.zeros(runs, dtype=bool)
+        self.rounds = []
+
+        if self.store is not None:
+            settings = {
+                'seed': self.seed,
+                'parameters': self.parameters_list,
+                'fixed_parameters': self.fixed_parameters,
+                'iterations': self.iterations,
+                'max_steps': self.max_steps,
+                'skip_values': SKIP_VALUES,
+                'seeds': 'sample, row, iteration',
+            }
+            if common_random_numbers:
+                settings['common_random_numbers'] = True
+            if ensemble:
+                settings['ensemble'] = True
+            self.store.open(settings)
+
+    def result_columns(self):
+        """Returns the name and dtype of the columns of a result set. """
+        columns = {name: np.float64 for name in self.names}
+        columns.update({'seed': np.int64, 'Run': np.int64})
+        columns.update({name: np.float64 for name in self.model_reporters})
+        return columns
+
+    def _run_kwargs(self, run):
+        """Returns the keyword arguments of the model for a run index. """
+        iteration, row = divmod(run, len(self.param_values))
+        return run_kwargs(self.names, self.param_values[row],
+                          self.fixed_parameters, self.seed, self.block,
+                          self.common_random_numbers, row, iteration)
+
+    def _run_key(self, run):
+        """Returns the key of a run in the cache. """
+        kwargs = self._run_kwargs(run)
+        return run_key(self._version, kwargs, self.max_steps,
+                       self.model_reporters)
+
+    def _collect(self, run, values, writer):
+        """Store the reporter values of a finished run. Returns the key of
+        the run in self.model_vars.
+        """
+        kwargs = self._run_kwargs(run)
+        key = tuple(kwargs.values()) + (run,)
+        self.results[run] = [values[name] for name in self.model_reporters]
+        self.finished[run] = True
+        if writer is None:
+            self.model_vars[key] = values
+        else:
+            row = {name: kwargs[name] for name in self.names}
+            row.update(seed=kwargs['seed'], Run=run, **values)
+            writer.append(row)
+        return key
+
+    def run_all(self, coordinator=None, writer=None, samples=None):
+        """Run the model for all runs which are not in the store yet and
+        collect the model reporters, as soon as a run finishes.
+
+        With samples, only the runs of the first samples Saltelli samples
+        are run, which are a Saltelli sample of that size themselves.
+
+        The worker processes are started once and get the parameter values
+        through shared memory, so a task is only a (row, iteration) pair and
+        a result is a fixed-width record of the reporters as floats. With
+        ensemble, a task is a (row, iterations) pair of all iterations of a
+        sample which are not finished yet. With a
+        workqueue.Coordinator, the runs are served to remote workers instead.
+
+        Runs are handed to the workers in chunks by a CostScheduler, which
+        learns the cost of the samples from the finished runs. The share of
+        the time each worker was busy is stored in self.utilization and
+        printed at the end.
+
+        With a results.ResultsWriter, the results are written to it instead
+        of kept in self.model_vars. The writer and coordinator are not
+        closed, so they can be used for several calls.
+
+        Overwrites Mesa function to not keep all models in memory until the
+        end. Only model reporters are collected.
+        """
+        count = len(self.param_values)
+        rows = count
+        if samples is not None:
+            rows = self.block * samples
+        total_iterations = rows * self.iterations
+        scheduler = CostScheduler(self.param_values, self.processes)
+        pending = defaultdict(list)
+        done = self.store.runs if self.store is not None else {}
+        for run, (_, values) in done.items():
+            if run % count < rows and not self.finished[run]:
+                self._collect(run, values, writer)
+            scheduler.observe(run % count, self.store.seconds.get(run))
+        for iteration in range(self.iterations):
+            for row in range(rows):
+                run = iteration * count + row
+                if self.finished[run]:
+                    continue
+                if self.cache is not None:
+                    cached = self.cache.get(self._run_key(run))
+                    if cached is not None:
+                        values, seconds = cached
+                        key = self._collect(run, values, writer)
+                        if self.store is not None:
+                            self.store.append(run, key, values, seconds)
+                        scheduler.observe(row, seconds)
+                        continue
+                pending[row].append(iteration)
+        for row, iterations in pending.items():
+            if self.ensemble:
+                scheduler.add(row, iterations[0], (row, tuple(iterations)))
+            else:
+                for iteration in iterations:
+                    scheduler.add(row, iteration, (row, iteration))
+
+        matrix = shared_memory.SharedMemory(
+            create=True, size=max(self.param_values.nbytes, 1))
+        try:
+            np.ndarray(self.param_values.shape, dtype=np.float64,
+                       buffer=matrix.buf)[:] = self.param_values
+            initargs = (self.names, self.fixed_parameters, self.seed,
+                        self.block, self.common_random_numbers,
+                        self.max_steps, self.model_reporters)
+            dtype = record_dtype(self.model_reporters)
+            if coordinator is not None:
+                records = coordinator.run(
+                    scheduler, (self.model_cls, self.param_values) + initargs,
+                    dtype)
+            else:
+                records = self._run_scheduled(
+                    scheduler, (self.model_cls, matrix.name,
+                                self.param_values.shape) + initargs, dtype)
+
+            start = time.perf_counter()
+            busy = defaultdict(float)
+            remaining = sum(len(iterations) for iterations in pending.values())
+            with tqdm(total=total_iterations, initial=total_iterations - remaining,
+                      disable=not self.display_progress) as pbar:
+                for record in records:
+                    run, seconds = int(record['run']), float(record['seconds'])
+                    scheduler.observe(run % count, seconds)
+                    busy[int(record['pid'])] += seconds
+                    values = {name: float(record[name])
+                              for name in self.model_reporters}
+                    key = self._collect(run, values, writer)
+                    if self.store is not None:
+                        self.store.append(run, key, values, seconds)
+                    if self.cache is not None:
+                        self.cache.put(self._run_key(run), values, seconds)
+                    pbar.update()
+            elapsed = time.perf_counter() - start
+        finally:
+            matrix.close()
+            matrix.unlink()
+
+        self.utilization = {pid: seconds / elapsed
+                            for pid, seconds in busy.items()} if elapsed else {}
+        if self.display_progress and self.utilization:
+            print('Worker utilization:')
+            for pid, utilization in sorted(self.utilization.items()):
+                print(f'  {pid:>8}: {utilization:6.1%} busy '
+                      f'({busy[pid]:.1f} of {elapsed:.1f} s)')
+        if self.display_progress and self.cache is not None:
+            print(self.cache.summary())
+
+        return getattr(self, "model_vars", None), None, None, None
+
+    def analyze(self, outputs, samples=None, num_resamples=100,
+                conf_level=0.95, iterations=None):
+        """Computes the Sobol indices of outputs, averaged over iterations,
+        with bootstrap confidence intervals.
+
+        Args:
+            outputs (dict): Name and function of each output. A function
+                gets a dictionary with an (iterations, samples) array of
+                every reporter and returns an array of the output.
+            samples (int): Use only the runs of the first samples samples.
+            num_resamples (int): Number of bootstrap resamples.
+            conf_level (float): Confidence level of the intervals.
+            iterations (int): Use only the first iterations iterations.
+
+        Returns:
+            Dictionary of the SALib result of every output.
+        """
+        seed = int(np.random.SeedSequence(self.seed).generate_state(1)[0])
+        values = self.output_values(outputs, samples, iterations)
+        return {name: sobol.analyze(
+                    self.problem, output, num_resamples=num_resamples,
+                    conf_level=conf_level, seed=seed)
+                for name, output in values.items()}
+
+    def output_values(self, outputs, samples=None, iterations=None):
+        """Returns the value of every output for each Saltelli sample,
+        averaged over iterations. See analyze for the arguments.
+        """
+        count = len(self.param_values)
+        rows = count
+        if samples is not None:
+            rows = self.block * samples
+        results = self.results.reshape(
+            self.iterations, count, -1)[:iterations, :rows]
+        reporters = {name: results[:, :, i]
+                     for i, name in enumerate(self.model_reporters)}
+        return {name: np.mean(output(reporters), axis=0)
+                for name, output in outputs.items()}
+
+    def iteration_report(self, outputs, samples=None, slack=0.05, **kwargs):
+        """Reports how the confidence of the Sobol indices depends on the
+        number of iterations, to choose the number of iterations of a next
+        batch run, for instance with or without common_random_numbers.
+
+        Args:
+            outputs (dict): Outputs to analyze, see analyze.
+            samples (int): Use only the runs of the first samples samples.
+            slack (float): Relative margin for the iterations needed.
+            kwargs: Passed to analyze.
+
+        Returns:
+            Tuple of a DataFrame of the largest half-width of the confidence
+            intervals of the first and total order indices of every output,
+            for the first 1 up to all iterations, and a dictionary of the
+            fewest iterations needed per output to be within slack of the
+            confidence reached with all iterations.
+        """
+        widths = []
+        for iterations in range(1, self.iterations + 1):
+            indices = self.analyze(outputs, samples, iterations=iterations,
+                                   **kwargs)
+            widths.append({name: max(np.nan_to_num(result[key]).max()
+                                     for key in ('S1_conf', 'ST_conf'))
+                           for name, result in indices.items()})
+        report = pd.DataFrame(widths, index=pd.RangeIndex(
+            1, self.iterations + 1, name='iterations'))
+        needed = {name: int(report.index[
+                      report[name] <= (1 + slack) * report[name].iloc[-1]][0])
+                  for name in report.columns}
+        return report, needed
+
+    def run_adaptive(self, outputs, tolerance, min_samples=8,
+                     coordinator=None, writer=None, **kwargs):
+        """Run Saltelli samples of increasing powers of two, until the
+        confidence intervals of the first and total order indices of all
+        outputs are narrower than tolerance, or all distinct_samples are
+        run. Runs of smaller rounds are reused in the larger ones.
+
+        Args:
+            outputs (dict): Outputs to analyze, see analyze.
+            tolerance (float): Maximum half-width of the intervals.
+            min_samples (int): Number of samples of the first round.
+            kwargs: Passed to analyze.
+
+        Returns:
+            The indices of the last round. Every round is recorded in
+            self.rounds.
+        """
+        samples = min(min_samples, self.distinct_samples)
+        block = self.block
+        while True:
+            self.run_all(coordinator, writer, samples)
+            indices = self.analyze(outputs, samples, **kwargs)
+            # Outputs without variance have undefined indices, they do not
+            # need more samples.
+            conf = max(np.nan_to_num(result[key]).max()
+                       for result in indices.values()
+                       for key in ('S1_conf', 'ST_conf'))
+            for values in self.output_values(outputs, samples).values():
+                # The bootstrap finds no variance when the outputs of the
+                # A and B matrices are equal, even if the others are not.
+                a_b = np.r_[values[::block], values[block - 1::block]]
+                if np.ptp(a_b) == 0 and np.ptp(values) > 0:
+                    conf = np.inf
+            self.rounds.append({'samples': samples,
+                                'runs': int(np.count_nonzero(self.finished)),
+                                'max_conf': float(conf)})
+            if self.display_progress:
+                print(f'{samples} samples: largest confidence interval '
+                      f'+/- {conf:.3f}, tolerance {tolerance}')
+            if conf <= tolerance or samples >= self.distinct_samples:
+                return indices
+            samples = min(2 * samples, self.distinct_samples)
+
+    def _run_scheduled(self, scheduler, initargs, dtype):
+        """Run the chunks of the scheduler, keeping every worker busy with
+        a chunk and one queued. Yields the result record of every task.
+        """
+        if self.processes <= 1:
+            attach_worker(*initargs)
+            try:
+                while len(scheduler):
+                    yield from np.frombuffer(
+                        run_tasks(scheduler.next_chunk()), dtype=dtype)
+            finally:
+                worker.pop('matrix').close()
+                worker.clear()
+            return
+
+        with Pool(self.processes, attach_worker, initargs) as pool:
+            running = []
+            while running or len(scheduler):
+                while len(scheduler) and len(running) < 2 * self.processes:
+                    running.append(pool.apply_async(
+                        run_tasks, (scheduler.next_chunk(),)))
+                finished = [result for result in running if result.ready()]
+                if not finished:
+                    running[0].wait(0.01)
+                    continue
+                for result in finished:
+                    running.remove(result)
+                    yield from np.frombuffer(result.get(), dtype=dtype)
+            pool.close()
+            pool.join()
 
     def _prepare_report_table(self, vars_dict, extra_cols=None):
         """
@@ -37,7 +765,7 @@ class SobolBatchRunner(BatchRunnerMP):
         index_cols = []
         if self.parameters_list:
             index_cols = list(self.parameters_list[0].keys(
-            )) + list(self.fixed_parameters.keys())
+            )) + list(self.fixed_parameters.keys()) + ['seed']
         index_cols += extra_cols
 
         records = []
@@ -60,37 +788,3 @@ class SobolBatchRunner(BatchRunnerMP):
                 vallist = [val for i in range(ordered.shape[0])]
                 ordered[param] = vallist
         return ordered
-
-    def _make_model_args_mp(self):
-        """Prepare all combinations of parameter values for `run_all`
-        Due to multiprocessing requirements of @StaticMethod takes different input, hence the similar function
-        Returns:
-            List of list with the form:
-            [[model_object, dictionary_of_kwargs, max_steps, iterations]]
-
-        Overwrites Mesa function to better work with sobol variable parameter input.
-        """
-        total_iterations = self.iterations
-        all_kwargs = []
-
-        count = len(self.parameters_list)
-        if count:
-            for i, params in enumerate(self.parameters_list):
-                kwargs = params.copy()
-                kwargs.update(self.fixed_parameters)
-                # run each iterations specific number of times
-                for iter in range(self.iterations):
-                    kwargs_repeated = kwargs.copy()
-                    all_kwargs.append(
-                        [self.model_cls, kwargs_repeated,
-                            self.max_steps, iter * count + i]
-                    )
-
-        elif len(self.fixed_parameters):
-            count = 1
-            kwargs = self.fixed_parameters.copy()
-            all_kwargs.append(kwargs)
-
-        total_iterations *= count
-
-        return all_kwargs, total_iterations
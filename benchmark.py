@@ -0,0 +1,394 @@
+"""
+Implements benchmarks of the model.
+
+    python benchmark.py memory
+    python benchmark.py suite --out baseline.json
+    python benchmark.py suite --out current.json
+    python benchmark.py compare baseline.json current.json
+
+The suite measures the throughput of the model and its parts and saves the
+results as JSON. compare flags the results of the second file which are
+worse than those of the first by more than a threshold, and exits with
+status 1 when there are any.
+"""
+
+import argparse
+from datetime import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from mesa import Agent
+
+from agents import Death, Predator, Prey
+from model import PreyPredatorModel
+
+
+def bytes_per_agent(create, n):
+    """Returns the average number of bytes allocated per agent by create. """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    agents = [create(i) for i in range(n)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # The list holding the agents is not part of the agents.
+    return (after - before) / len(agents) - 8
+
+
+def mesa_agent(model, unique_id, pos, **attributes):
+    """Returns a mesa.Agent with the same attributes as our agent classes,
+    as the agents were implemented before using __slots__.
+    """
+    agent = Agent(unique_id, model)
+    agent.pos = pos
+    agent.last_pos = pos
+    for name, value in attributes.items():
+        setattr(agent, name, value)
+    return agent
+
+
+def memory(args):
+    """Report bytes per agent for mesa.Agent and slotted agent classes. """
+    model = PreyPredatorModel(initial_prey=0, initial_predator=0,
+                              grass_clusters=0, collect_data=False)
+    pos = (1.0, 2.0)
+
+    def slotted(agent_type, *args):
+        def create(i):
+            agent = agent_type(i, model, pos, *args)
+            agent.last_pos = pos
+            return agent
+        return create
+
+    benchmarks = {
+        'Prey': (slotted(Prey), dict(energy=20)),
+        'Predator': (slotted(Predator), dict(energy=40)),
+        'Death': (slotted(Death, 'Prey'), dict(animal_type='Prey', duration=0)),
+    }
+
+    print(f'{"agent":<10}{"before (B)":>12}{"after (B)":>12}')
+    for name, (create, attributes) in benchmarks.items():
+        before = bytes_per_agent(
+            lambda i: mesa_agent(model, i, pos, **attributes), args.n)
+        after = bytes_per_agent(create, args.n)
+        print(f'{name:<10}{before:>12.0f}{after:>12.0f}')
+
+
+def timed(setup, run, repeat):
+    """Returns the shortest time of repeat calls of run, each on a new
+    state returned by setup, and the result of the last call.
+    """
+    best, result = np.inf, None
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        result = run(state)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def result(benchmark, params, metric, value, higher_is_better):
+    """Returns the record of one measurement of the suite. """
+    return {'benchmark': benchmark, 'params': params, 'metric': metric,
+            'value': value, 'higher_is_better': higher_is_better}
+
+
+def describe(params):
+    """Returns the parameters of a measurement as text. """
+    return ', '.join(f'{key}={value}' for key, value in params.items())
+
+
+def empty_model(**kwargs):
+    """Returns a model without animals and grass. """
+    return PreyPredatorModel(initial_prey=0, initial_predator=0,
+                             grass_clusters=0, collect_data=False, seed=0,
+                             **kwargs)
+
+
+def add_prey(model, n):
+    """Adds n prey at random positions to a model. """
+    for pos in model.rng.uniform(0, model.space.width, (n, 2)):
+        model.new_agent(Prey, tuple(pos))
+
+
+def bench_step(args):
+    """Steps per second of PreyPredatorModel.step, for both engines and
+    several population sizes and grass densities.
+    """
+    results = []
+    for vectorized in (False, True):
+        for n in args.populations:
+            for cluster_size in args.grass_cluster_sizes:
+                params = {'vectorized': vectorized, 'initial_prey': n,
+                          'initial_predator': n // 5,
+                          'grass_cluster_size': cluster_size}
+
+                def run(model):
+                    for _ in range(args.steps):
+                        model.step()
+                    return model.schedule.steps
+
+                seconds, steps = timed(
+                    lambda: PreyPredatorModel(collect_data=False, seed=0,
+                                              **params),
+                    run, args.repeat)
+                results.append(result('step', params, 'steps/s',
+                                      steps / seconds, True))
+    return results
+
+
+def bench_space(args):
+    """Latency of get_agent_neighbors and get_vector_to_agents, for several
+    numbers of agents and radii.
+    """
+    results = []
+    for n in args.agents:
+        model = empty_model()
+        add_prey(model, n)
+        positions = [tuple(pos) for pos in model.rng.uniform(
+            0, model.space.width, (args.queries, 2))]
+        for radius in args.radii:
+            for name in ('get_agent_neighbors', 'get_vector_to_agents'):
+                query = getattr(model.space, name)
+
+                def run(_):
+                    for pos in positions:
+                        query(pos, Prey, radius)
+
+                seconds, _ = timed(lambda: None, run, args.repeat)
+                results.append(result(
+                    name, {'agents': n, 'radius': radius}, 'us/query',
+                    1e6 * seconds / len(positions), False))
+    return results
+
+
+def bench_remove(args):
+    """Cost of PreyPredatorModel.remove_agent, removing all agents of a
+    model in random order.
+    """
+    results = []
+    for n in args.agents:
+        def setup():
+            model = empty_model()
+            add_prey(model, n)
+            agents = model.space.get_agents(Prey)
+            model.rng.shuffle(agents)
+            return model, agents
+
+        def run(state):
+            model, agents = state
+            for agent in agents:
+                model.remove_agent(agent)
+
+        seconds, _ = timed(setup, run, args.repeat)
+        results.append(result('remove_agent', {'agents': n}, 'us/agent',
+                              1e6 * seconds / n, False))
+    return results
+
+
+def bench_render(args):
+    """Time per frame of CanvasContinuous.render, with the canvas of the
+    server, after a few steps so there are deaths to draw.
+    """
+    from server import grid
+
+    results = []
+    for n in args.populations:
+        model = PreyPredatorModel(initial_prey=n, initial_predator=n // 5,
+                                  seed=0)
+        for _ in range(5):
+            model.step()
+
+        def run(_):
+            for _ in range(args.frames):
+                grid.render(model)
+
+        seconds, _ = timed(lambda: None, run, args.repeat)
+        results.append(result('render', {'initial_prey': n}, 'ms/frame',
+                              1e3 * seconds / args.frames, False))
+    return results
+
+
+def bench_batch(args):
+    """Runs per second of a small SobolBatchRunner experiment, for several
+    numbers of worker processes.
+    """
+    from batchrunner import SobolBatchRunner
+
+    problem = {
+        'num_vars': 3,
+        'names': ['prey_cohere_factor', 'prey_separate_factor',
+                  'prey_separate_predators_factor'],
+        'bounds': [[0, 2], [0, 2], [0, 2]],
+    }
+    model_reporters = {
+        'Predator': lambda m: m.schedule_Predator.get_agent_count(),
+        'Prey': lambda m: m.schedule_Prey.get_agent_count(),
+        'Time': lambda m: m.schedule.steps,
+    }
+    results = []
+    for workers in args.workers:
+        def setup():
+            batch = SobolBatchRunner(
+                PreyPredatorModel, problem, args.samples, seed=0,
+                max_steps=args.max_steps, iterations=1,
+                fixed_parameters={'collect_data': False, 'vectorized': True},
+                model_reporters=model_reporters, display_progress=False)
+            batch.processes = workers
+            return batch
+
+        def run(batch):
+            batch.run_all()
+            return len(batch.results)
+
+        seconds, runs = timed(setup, run, args.repeat)
+        results.append(result(
+            'SobolBatchRunner',
+            {'workers': workers, 'samples': args.samples,
+             'max_steps': args.max_steps},
+            'runs/s', runs / seconds, True))
+    return results
+
+
+BENCHMARKS = {
+    'step': bench_step,
+    'space': bench_space,
+    'remove': bench_remove,
+    'render': bench_render,
+    'batch': bench_batch,
+}
+
+
+def environment():
+    """Returns a description of the machine and code of a suite run. """
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def suite(args):
+    """Run the benchmarks of the suite and save the results as JSON. """
+    if args.quick:
+        args.populations = args.populations[:2]
+        args.agents = args.agents[:2]
+        args.repeat = 1
+    results = []
+    for name in args.only or BENCHMARKS:
+        print(f'Running {name} benchmarks...', file=sys.stderr)
+        for record in BENCHMARKS[name](args):
+            print(f'{record["benchmark"]:<22}{describe(record["params"]):<70}'
+                  f'{record["value"]:>12.2f} {record["metric"]}')
+            results.append(record)
+    if args.out:
+        with open(args.out, 'w') as out_file:
+            json.dump({'environment': environment(), 'results': results},
+                      out_file, indent=2)
+
+
+def compare(args):
+    """Compare the results of two suite runs and flag regressions. """
+    def load(path):
+        with open(path) as in_file:
+            data = json.load(in_file)
+        return data['environment'], {
+            (record['benchmark'], record['metric'],
+             json.dumps(record['params'], sort_keys=True)): record
+            for record in data['results']}
+
+    old_environment, old = load(args.baseline)
+    new_environment, new = load(args.current)
+    for key in ('platform', 'processor', 'cpu_count'):
+        if old_environment.get(key) != new_environment.get(key):
+            print(f'Warning: {key} differs: {old_environment.get(key)} '
+                  f'and {new_environment.get(key)}')
+
+    regressions = 0
+    for key, record in old.items():
+        if key not in new:
+            print(f'Missing in {args.current}: {key[0]} '
+                  f'{describe(record["params"])}')
+            continue
+        benchmark, metric = key[:2]
+        params = describe(record['params'])
+        before, after = record['value'], new[key]['value']
+        change = after / before - 1 if before else 0
+        # Positive when better, for both kinds of metrics.
+        gain = change if record['higher_is_better'] else -change
+        status = ''
+        if gain < -args.threshold:
+            status = 'REGRESSION'
+            regressions += 1
+        elif gain > args.threshold:
+            status = 'improved'
+        print(f'{benchmark:<22}{params:<70}{before:>12.2f}{after:>12.2f} '
+              f'{metric:<9}{change:>+8.1%} {status}')
+    print(f'{regressions} regressions of more than {args.threshold:.0%}')
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    memory_parser = subparsers.add_parser(
+        'memory', help='bytes per agent before and after using __slots__')
+    memory_parser.add_argument('--n', default=100000, type=int)
+    memory_parser.set_defaults(func=memory)
+
+    suite_parser = subparsers.add_parser(
+        'suite', help='measure throughput and save the results as JSON')
+    suite_parser.add_argument('--out', type=str,
+                              help='JSON file to save the results to')
+    suite_parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS),
+                              help='run only these benchmarks')
+    suite_parser.add_argument('--quick', action='store_true',
+                              help='fewer sizes and a single repetition')
+    suite_parser.add_argument('--repeat', default=3, type=int,
+                              help='keep the best of this many repetitions')
+    suite_parser.add_argument('--steps', default=20, type=int)
+    suite_parser.add_argument('--populations', nargs='+', type=int,
+                              default=[100, 400, 1600])
+    suite_parser.add_argument('--grass_cluster_sizes', nargs='+', type=int,
+                              default=[30, 60, 120])
+    suite_parser.add_argument('--agents', nargs='+', type=int,
+                              default=[100, 1000, 10000])
+    suite_parser.add_argument('--radii', nargs='+', type=float,
+                              default=[10.0, 40.0, 100.0])
+    suite_parser.add_argument('--queries', default=1000, type=int)
+    suite_parser.add_argument('--frames', default=10, type=int)
+    suite_parser.add_argument('--workers', nargs='+', type=int,
+                              default=sorted({1, 2, os.cpu_count() or 1}))
+    suite_parser.add_argument('--samples', default=4, type=int,
+                              help='distinct samples of the batch benchmark')
+    suite_parser.add_argument('--max_steps', default=50, type=int)
+    suite_parser.set_defaults(func=suite)
+
+    compare_parser = subparsers.add_parser(
+        'compare', help='flag regressions between two saved suite runs')
+    compare_parser.add_argument('baseline', type=str)
+    compare_parser.add_argument('current', type=str)
+    compare_parser.add_argument('--threshold', default=0.1, type=float,
+                                help='relative change counted as regression')
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -1,33 +1,338 @@
 """
 The collector class used in this project.
 
-Core class: PreyPredatorCollector
+Core classes: PreyPredatorCollector, NpySink, DynamicsSummary
 
 """
+import struct
+
 import numpy as np
+import pandas as pd
 
-from mesa.datacollection import DataCollector
 
 def get_average_energy(animal):
     """Returns average energy of a type of animal. """
     def calc_average_energy(model):
-        """Calculates and return average energy. """
-        agents = getattr(model, f'schedule_{animal}').agents
-        if len(agents) > 0:
-            return np.mean([agent.energy for agent in agents])
+        """Calculates and return average energy from the total energy kept
+        up to date by the model.
+        """
+        count = getattr(model, f'schedule_{animal}').get_agent_count()
+        if count > 0:
+            return model.total_energy[animal] / count
         else:
             return 0
     return calc_average_energy
 
-class PreyPredatorCollector(DataCollector):
-    """Prey-predator collector class extending DataCollector """
 
-    def __init__(self, **params):
-        """Create model reporter which collect animal count and average energy. """
-        model_reporters = {
+class NpySink:
+    """Appends records to a .npy file, which can be opened lazily with
+    load_model_vars while it is being written.
+
+    The header of the file has a fixed size and is rewritten with the new
+    number of records after every write, so the file is always valid.
+    """
+
+    def __init__(self, path, dtype):
+        """Create an empty .npy file.
+
+        Args:
+            path (str): Path of the file, overwritten if it exists.
+            dtype (np.dtype): Structured dtype of the records.
+        """
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.n = 0
+        self.header_size = len(self._header(np.iinfo(np.int64).max))
+        with open(self.path, 'wb') as out_file:
+            out_file.write(self._header(0))
+
+    def _header(self, n):
+        """Returns the .npy header for n records, padded to a fixed size. """
+        header = repr({
+            'descr': np.lib.format.dtype_to_descr(self.dtype),
+            'fortran_order': False,
+            'shape': (n,),
+        })
+        size = getattr(self, 'header_size', None)
+        if size is None:
+            # Magic string, header length and newline, aligned to 64 bytes.
+            size = -(-(len(header) + 11) // 64) * 64
+        header = header.ljust(size - 11) + '\n'
+        return np.lib.format.magic(1, 0) + \
+            struct.pack('<H', len(header)) + header.encode('latin1')
+
+    def write(self, records):
+        """Append an array of records to the file. """
+        records = np.asarray(records, dtype=self.dtype)
+        with open(self.path, 'r+b') as out_file:
+            out_file.seek(self.header_size + self.n * self.dtype.itemsize)
+            out_file.write(records.tobytes())
+            self.n += len(records)
+            out_file.seek(0)
+            out_file.write(self._header(self.n))
+
+
+def load_model_vars(path):
+    """Returns the records written by a NpySink as a read-only memory-mapped
+    structured array, so columns and ranges of steps are only read from
+    disk when used.
+    """
+    return np.load(path, mmap_mode='r')
+
+
+class PreyPredatorCollector:
+    """Prey-predator collector which stores the model reporters in
+    preallocated columns, growing geometrically when full.
+
+    Can be used in place of mesa.DataCollector by the ChartModules, which
+    read the last value of each column from model_vars.
+
+    With a sink, the columns have a fixed size and are flushed to the sink
+    whenever they are full, so memory use does not grow with the number of
+    steps. model_vars then only holds the steps since the last flush.
+    """
+
+    def __init__(self, capacity=1024, stride=1, sink_path=None):
+        """Create model reporters which collect animal count and average
+        energy.
+
+        Args:
+            capacity (int): Number of steps to allocate space for, or the
+                number of steps per chunk written to the sink.
+            stride (int): Only collect every stride-th step.
+            sink_path (str): Path of a .npy file to stream the data to.
+        """
+        self.model_reporters = {
             'Prey': lambda m: m.schedule_Prey.get_agent_count(),
             'Predators': lambda m: m.schedule_Predator.get_agent_count(),
             'Prey energy': get_average_energy('Prey'),
             'Predator energy': get_average_energy('Predator'),
         }
-        super().__init__(model_reporters, **params)
+        self.agent_reporters = None
+        self.columns = list(self.model_reporters)
+        self.stride = stride
+        self.n = 0
+        self._steps = np.empty(capacity, dtype=np.int64)
+        self._data = np.empty((capacity, len(self.columns)))
+
+        self.sink = None
+        if sink_path is not None:
+            dtype = [('Step', np.int64)] + \
+                [(name, np.float64) for name in self.columns]
+            self.sink = NpySink(sink_path, dtype)
+
+    def collect(self, model):
+        """Collect the model reporters for the current step. """
+        step = model.schedule.steps
+        if step % self.stride:
+            return
+        if self.n == len(self._data):
+            if self.sink is not None:
+                self.flush()
+            else:
+                self._steps = np.resize(self._steps, 2 * self.n)
+                data = np.empty((2 * self.n, len(self.columns)))
+                data[:self.n] = self._data
+                self._data = data
+        self._steps[self.n] = step
+        row = self._data[self.n]
+        for i, reporter in enumerate(self.model_reporters.values()):
+            row[i] = reporter(model)
+        self.n += 1
+
+    def flush(self):
+        """Write the collected steps to the sink and empty the columns. """
+        if self.sink is None or self.n == 0:
+            return
+        records = np.empty(self.n, dtype=self.sink.dtype)
+        records['Step'] = self._steps[:self.n]
+        for i, name in enumerate(self.columns):
+            records[name] = self._data[:self.n, i]
+        self.sink.write(records)
+        self.n = 0
+
+    @property
+    def model_vars(self):
+        """Dictionary of the collected values of each reporter. """
+        data = self._data[:self.n]
+        return {name: data[:, i] for i, name in enumerate(self.columns)}
+
+    def get_model_vars_dataframe(self):
+        """Returns a DataFrame of the collected model variables indexed by
+        step. Without a sink it shares memory with the collector, with a
+        sink the steps are flushed and all of them are read from the file.
+        """
+        if self.sink is not None:
+            self.flush()
+            records = load_model_vars(self.sink.path)
+            return pd.DataFrame(
+                {name: records[name] for name in self.columns},
+                index=pd.Index(records['Step'], name='Step'))
+        return pd.DataFrame(self._data[:self.n], columns=self.columns,
+                            index=pd.Index(self._steps[:self.n], name='Step'),
+                            copy=False)
+
+
+class DynamicsSummary:
+    """Online summary of the population dynamics of one or more replicas,
+    in memory independent of the number of steps.
+
+    Keeps the minimum, maximum, mean and standard deviation of the prey and
+    predator counts, their autocorrelation up to max_lag steps, from which
+    the dominant period of the oscillation is estimated, and a trajectory
+    of the counts at every stride-th step, of at most points points.
+    """
+
+    species = ('Prey', 'Predator')
+
+    def __init__(self, points=64, stride=16, max_lag=400, replicas=1):
+        """Create an empty summary.
+
+        Args:
+            points (int): Number of points of the trajectories.
+            stride (int): Steps between the points of the trajectories.
+            max_lag (int): Largest lag of the autocorrelation.
+            replicas (int): Number of replicas which are summarized.
+        """
+        self.points = points
+        self.stride = stride
+        self.max_lag = max_lag
+        shape = (replicas, len(self.species))
+        self.n = np.zeros(replicas, dtype=np.int64)
+        self.total = np.zeros(shape)
+        self.total_sq = np.zeros(shape)
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+        # Sums of the products of counts lag steps apart, the first max_lag
+        # counts and the last max_lag counts (the last count first).
+        self.products = np.zeros(shape + (max_lag,))
+        self.head = np.zeros(shape + (max_lag,))
+        self.recent = np.zeros(shape + (max_lag,))
+        self.trajectory = np.full(shape + (points,), np.nan)
+        # Replica to (steps, statistics) of the last statistics computed.
+        self._statistics = {}
+
+    def update(self, step, counts, replicas=slice(None)):
+        """Add the counts of a step.
+
+        Args:
+            step (int): Step of the counts, starting at 0.
+            counts (ndarray): (replicas, 2) array of prey and predator counts.
+            replicas: Index of the replicas of the counts, by default all.
+        """
+        counts = np.asarray(counts, dtype=float).reshape(-1, len(self.species))
+        self.n[replicas] += 1
+        self.total[replicas] += counts
+        self.total_sq[replicas] += counts ** 2
+        self.min[replicas] = np.minimum(self.min[replicas], counts)
+        self.max[replicas] = np.maximum(self.max[replicas], counts)
+        self.products[replicas] += counts[..., None] * self.recent[replicas]
+        recent = self.recent[replicas]
+        recent[..., 1:] = recent[..., :-1]
+        recent[..., 0] = counts
+        self.recent[replicas] = recent
+        if step < self.max_lag:
+            self.head[replicas, :, step] = counts
+        if step % self.stride == 0 and step // self.stride < self.points:
+            self.trajectory[replicas, :, step // self.stride] = counts
+
+    def autocorrelation(self, replica=0):
+        """Returns a (2, max_lag) array of the autocorrelation of the prey
+        and predator counts of a replica at lags 1 up to max_lag, NaN for
+        lags longer than half the steps or without variance.
+        """
+        n = self.n[replica]
+        mean = self.total[replica] / n
+        variance = self.total_sq[replica] / n - mean ** 2
+        lags = np.arange(1, self.max_lag + 1)
+        pairs = n - lags
+        # Sums of the counts which have a count lag steps before and after.
+        later = self.total[replica][:, None] - \
+            np.cumsum(self.head[replica], axis=1)
+        earlier = self.total[replica][:, None] - \
+            np.cumsum(self.recent[replica], axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            covariance = (self.products[replica] - mean[:, None] * (later + earlier)
+                          + pairs * mean[:, None] ** 2) / pairs
+            correlation = covariance / variance[:, None]
+        correlation[:, lags > n // 2] = np.nan
+        correlation[variance <= 0] = np.nan
+        return correlation
+
+    @staticmethod
+    def dominant_period(correlation):
+        """Returns the lag and the autocorrelation of the first peak of an
+        autocorrelation at lags 1, 2, ..., or NaNs if there is none.
+
+        The peak is the first local maximum after the autocorrelation first
+        becomes negative. To skip noise, it is found in the autocorrelation
+        smoothed over a quarter of the lag of the first negative value
+        (about a sixteenth of the period of an oscillation), and then
+        refined in the unsmoothed one.
+        """
+        known = np.flatnonzero(np.isnan(correlation))
+        correlation = correlation[:known[0] if len(known) else None]
+        negative = np.flatnonzero(correlation < 0)
+        if not len(negative):
+            return np.nan, np.nan
+        width = max(1, negative[0] // 4)
+        smooth = np.convolve(correlation, np.ones(2 * width + 1) / (2 * width + 1),
+                             mode='same')
+        middle = smooth[1:-1]
+        peaks = 1 + np.flatnonzero(
+            (middle > 0) & (middle >= smooth[:-2]) & (middle > smooth[2:]))
+        # Near the last lag the smoothing is biased towards zero.
+        peaks = peaks[(peaks > negative[0]) &
+                      (peaks < len(correlation) - width)]
+        if not len(peaks):
+            return np.nan, np.nan
+        start = max(peaks[0] - width, 0)
+        lag = start + int(np.argmax(correlation[start:peaks[0] + width + 1]))
+        return lag + 1, correlation[lag]
+
+    def statistics(self, replica=0):
+        """Returns a dictionary of the summary of a replica, computed once
+        per number of steps and shared by all its reporters.
+
+        The dominant period is estimated by dominant_period.
+        """
+        n = self.n[replica]
+        cached = self._statistics.get(replica)
+        if cached is not None and cached[0] == n:
+            return cached[1]
+        correlation = self.autocorrelation(replica)
+        statistics = {}
+        for i, name in enumerate(self.species):
+            mean = self.total[replica, i] / n
+            statistics[f'{name} min'] = self.min[replica, i]
+            statistics[f'{name} max'] = self.max[replica, i]
+            statistics[f'{name} mean'] = mean
+            statistics[f'{name} std'] = np.sqrt(max(
+                self.total_sq[replica, i] / n - mean ** 2, 0))
+            period, peak = self.dominant_period(correlation[i])
+            statistics[f'{name} period'] = period
+            statistics[f'{name} autocorrelation'] = peak
+            for point in range(self.points):
+                statistics[f'{name}@{point * self.stride}'] = \
+                    self.trajectory[replica, i, point]
+        statistics = {name: float(value) for name, value in statistics.items()}
+        self._statistics[replica] = (n, statistics)
+        return statistics
+
+    def reporters(self):
+        """Returns model reporters of every statistic, which read the
+        dynamics of the model (or of a replica of an ensemble).
+        """
+        def reporter(name):
+            return lambda m: m.dynamics[name]
+        return {name: reporter(name) for name in self.statistics_names()}
+
+    def statistics_names(self):
+        """Returns the names of the statistics, in order. """
+        names = []
+        for name in self.species:
+            names += [f'{name} {statistic}' for statistic in (
+                'min', 'max', 'mean', 'std', 'period', 'autocorrelation')]
+            names += [f'{name}@{point * self.stride}'
+                      for point in range(self.points)]
+        return names
@@ -0,0 +1,319 @@
+"""
+Vectorized simulation engine used by PreyPredatorModel(vectorized=True).
+
+Core classes: Population, VectorizedEngine
+
+Instead of stepping every animal as a separate agent, each species is
+stored as arrays and all animals of a species perform a phase (moving,
+eating, reproducing, dying) at once.
+"""
+
+import numpy as np
+
+
+class Population:
+    """Structure-of-arrays storage of all animals of one species.
+    Exposes get_agent_count, so it can be used in place of a scheduler.
+    """
+
+    def __init__(self, name, capacity=64):
+        """Create an empty population.
+
+        Args:
+            name (str): Name of the species, for instance 'Prey'.
+            capacity (int): Initial size of the arrays.
+        """
+        self.name = name
+        self.n = 0
+        self._pos = np.empty((capacity, 2))
+        self._last_pos = np.empty((capacity, 2))
+        self._energy = np.empty(capacity)
+        self._alive = np.zeros(capacity, dtype=bool)
+        self._group = np.zeros(capacity, dtype=int)
+
+    @property
+    def positions(self):
+        """(n, 2) array of positions. """
+        return self._pos[:self.n]
+
+    @property
+    def last_positions(self):
+        """(n, 2) array of positions before the last move. """
+        return self._last_pos[:self.n]
+
+    @property
+    def energy(self):
+        """Array of energy levels. """
+        return self._energy[:self.n]
+
+    @property
+    def alive(self):
+        """Boolean array if animal is alive. """
+        return self._alive[:self.n]
+
+    @property
+    def group(self):
+        """Array of the replica of each animal, see ensemble.py. """
+        return self._group[:self.n]
+
+    def get_agent_count(self):
+        """Returns the number of living animals. """
+        return int(np.count_nonzero(self.alive))
+
+    def add(self, positions, energy, group=0):
+        """Add new animals at positions with an initial energy level, in
+        replica group.
+        """
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        start, end = self.n, self.n + len(positions)
+        if end > len(self._alive):
+            capacity = max(end, 2 * len(self._alive))
+            self._pos = np.resize(self._pos, (capacity, 2))
+            self._last_pos = np.resize(self._last_pos, (capacity, 2))
+            self._energy = np.resize(self._energy, capacity)
+            self._alive = np.resize(self._alive, capacity)
+            self._group = np.resize(self._group, capacity)
+        self._pos[start:end] = positions
+        self._last_pos[start:end] = positions
+        self._energy[start:end] = energy
+        self._alive[start:end] = True
+        self._group[start:end] = group
+        self.n = end
+
+    def compact(self):
+        """Remove dead animals from the arrays. """
+        keep = self.alive.copy()
+        k = int(np.count_nonzero(keep))
+        self._pos[:k] = self.positions[keep]
+        self._last_pos[:k] = self.last_positions[keep]
+        self._energy[:k] = self.energy[keep]
+        self._alive[:k] = True
+        self._group[:k] = self.group[keep]
+        self.n = k
+
+
+class VectorizedEngine:
+    """Steps a PreyPredatorModel with a whole species per phase.
+
+    Animals act simultaneously within their phase, so conflicts (two prey
+    eating the same patch of grass, two predators catching the same prey)
+    are resolved in random order over a few rounds.
+
+    When grouped, the animals and grass are divided over independent
+    replicas of the model by their group (see ensemble.py), and animals
+    only see the animals and grass of their own replica.
+    """
+
+    def __init__(self, model):
+        """Create engine for a model, using the parameters of the model. """
+        self.model = model
+        self.rng = model.rng
+        self.prey = Population('Prey')
+        self.predators = Population('Predator')
+        self.grouped = False
+
+    def add(self, name, positions):
+        """Add new animals of species name at positions. """
+        if name == 'Prey':
+            self.prey.add(positions, 2 * self.model.prey_gain_from_food)
+        else:
+            self.predators.add(
+                positions, 2 * self.model.predator_gain_from_food)
+        self.update_total_energy()
+
+    def groups(self, queries, points):
+        """Returns the groups argument of the space queries of the animals
+        or grass of queries near points, when grouped.
+        """
+        if not self.grouped:
+            return None
+        return queries, points
+
+    def update_total_energy(self):
+        """Update the total energy of both species in the model. """
+        for population in (self.prey, self.predators):
+            self.model.total_energy[population.name] = \
+                float(population.energy.sum())
+
+    def step(self):
+        """Perform a single time step for all animals and grass. """
+        self.step_prey()
+        self.step_predators()
+        self.model.grass.step()
+        self.update_total_energy()
+
+    def move(self, population, vectors, distance=25):
+        """Move all animals a distance towards their vector, or randomly
+        up to distance when the vector is zero.
+        """
+        space = self.model.space
+        n = population.n
+        norms = np.linalg.norm(vectors, axis=1)
+        directed = norms > 0
+
+        steps = np.empty((n, 2))
+        steps[directed] = distance * vectors[directed] / norms[directed, None]
+
+        n_random = n - int(np.count_nonzero(directed))
+        distances = self.rng.uniform(0, distance, n_random)
+        angles = np.radians(self.rng.uniform(0, 360, n_random))
+        steps[~directed, 0] = distances * np.sin(angles)
+        steps[~directed, 1] = distances * np.cos(angles)
+
+        population.last_positions[:] = population.positions
+        new = population.positions + steps
+        if space.torus:
+            new[:, 0] = space.x_min + (new[:, 0] - space.x_min) % space.width
+            new[:, 1] = space.y_min + (new[:, 1] - space.y_min) % space.height
+        population.positions[:] = new
+
+    def kill(self, population, dead):
+        """Mark animals as dead and record their deaths when headless.
+
+        Args:
+            population (Population): Population of the animals.
+            dead (ndarray): Indices or boolean mask of the animals.
+        """
+        population.alive[dead] = False
+        if self.model.deaths is not None:
+            self.model.deaths.extend(population.positions[dead],
+                                     population.name, self.model.schedule.steps)
+
+    def claim(self, claimers, targets, available):
+        """Let claimers pick a random target among their candidate pairs.
+        Every target is given to at most one claimer, in random order.
+
+        Args:
+            claimers (ndarray): Claimer index of each candidate pair.
+            targets (ndarray): Target index of each candidate pair.
+            available (ndarray): Boolean array which pairs may be claimed.
+
+        Returns:
+            Tuple of arrays (claimer, target) of successful claims.
+        """
+        order = self.rng.permutation(len(claimers))
+        claimers, targets = claimers[order][available[order]], \
+            targets[order][available[order]]
+        _, first = np.unique(claimers, return_index=True)
+        claimers, targets = claimers[first], targets[first]
+
+        order = self.rng.permutation(len(claimers))
+        _, first = np.unique(targets[order], return_index=True)
+        winners = order[first]
+        return claimers[winners], targets[winners]
+
+    def step_prey(self):
+        """Move, feed, reproduce and kill all prey at once. """
+        model, space, grass = self.model, self.model.space, self.model.grass
+        prey = self.prey
+        n = prey.n
+        positions = prey.positions
+        group = prey.group
+
+        # Flocking vectors, as in Prey.flock_vector.
+        result_vectors = \
+            -1 * model.prey_separate_factor * space.headings_to_points(
+                positions, positions, model.prey_reach,
+                groups=self.groups(group, group)) + \
+            -1 * model.prey_separate_predators_factor * space.headings_to_points(
+                positions, self.predators.positions, model.prey_sight,
+                groups=self.groups(group, self.predators.group)) + \
+            model.prey_cohere_factor * space.headings_to_points(
+                positions, positions, model.prey_sight,
+                groups=self.groups(group, group))
+
+        # Fully grown grass within reach, before moving.
+        q, g = space.neighbor_pairs(positions, grass.points, model.prey_reach,
+                                    self.groups(group, grass.groups))
+        grown = grass.fully_grown[g]
+        q, g = q[grown], g[grown]
+        on_grass = np.bincount(q, minlength=n) > 0
+
+        hungry = (prey.energy < model.prey_food_search_max) & ~on_grass
+        if np.any(hungry):
+            result_vectors[hungry] += model.prey_hungry_factor * \
+                space.headings_to_points(
+                    positions[hungry], grass.points[grass.fully_grown],
+                    model.prey_sight, normalize=False,
+                    groups=self.groups(group[hungry],
+                                       grass.groups[grass.fully_grown]))
+
+        self.move(prey, result_vectors)
+
+        reproduce = (prey.energy > model.prey_reproduction_min) & \
+            (self.rng.random(n) < model.prey_reproduction_chance)
+
+        prey.energy[:] -= 1
+
+        # Each prey eats one patch, patches eaten by others are skipped.
+        fed = np.zeros(n, dtype=bool)
+        while True:
+            available = ~fed[q] & grass.fully_grown[g]
+            if not np.any(available):
+                break
+            eaters, patches = self.claim(q, g, available)
+            grass.fully_grown[patches] = False
+            fed[eaters] = True
+        prey.energy[fed] += model.prey_gain_from_food
+
+        dies = (prey.energy < 0) | \
+            (self.rng.random(n) < model.prey_death_chance)
+        self.kill(prey, dies)
+
+        prey.add(positions[reproduce], 2 * model.prey_gain_from_food,
+                 group[reproduce])
+        prey.compact()
+
+    def step_predators(self):
+        """Move, hunt, reproduce and kill all predators at once. """
+        model, space = self.model, self.model.space
+        predators, prey = self.predators, self.prey
+        n = predators.n
+
+        # Move towards prey when hungry, as in Predator.step.
+        vectors = np.zeros((n, 2))
+        hunting = predators.energy < model.predator_food_search_max
+        if np.any(hunting):
+            vectors[hunting] = space.headings_to_points(
+                predators.positions[hunting], prey.positions,
+                model.predator_sight,
+                groups=self.groups(predators.group[hunting], prey.group))
+        self.move(predators, vectors)
+
+        # Catch prey with less than 5 other prey surrounding it. Catching a
+        # prey leaves its neighbors lonelier for the next round.
+        q, p = space.neighbor_pairs(
+            predators.positions, prey.positions, model.predator_reach,
+            self.groups(predators.group, prey.group))
+        nq, np_ = space.neighbor_pairs(
+            prey.positions, prey.positions, model.predator_reach,
+            self.groups(prey.group, prey.group))
+        neighbor_counts = np.bincount(nq, minlength=prey.n)
+        fed = np.zeros(n, dtype=bool)
+        while True:
+            available = ~fed[q] & prey.alive[p] & (neighbor_counts[p] < 5)
+            if not np.any(available):
+                break
+            hunters, caught = self.claim(q, p, available)
+            self.kill(prey, caught)
+            fed[hunters] = True
+            killed = np.zeros(prey.n, dtype=bool)
+            killed[caught] = True
+            neighbor_counts -= np.bincount(
+                nq[killed[np_]], minlength=prey.n)
+        predators.energy[fed] += model.predator_gain_from_food
+        prey.compact()
+
+        reproduce = (predators.energy > model.predator_reproduction_min) & \
+            (self.rng.random(n) < model.predator_reproduction_chance)
+
+        predators.energy[:] -= 1
+
+        dies = (predators.energy < 0) | \
+            (self.rng.random(n) < model.predator_death_chance)
+        self.kill(predators, dies)
+
+        predators.add(predators.positions[reproduce],
+                      2 * model.predator_gain_from_food,
+                      predators.group[reproduce])
+        predators.compact()
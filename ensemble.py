@@ -0,0 +1,184 @@
+"""
+Runs replicas of one parameter set in lockstep, in a single engine.
+
+Core class: Ensemble
+
+The replicas are vectorized models which differ only in their seed. Their
+animals and grass are stored in the same arrays of one VectorizedEngine,
+with the replica of each animal and patch in a group array, so every phase
+of a step is performed for all replicas at once. Space queries only pair
+animals and grass of the same replica, so the replicas are independent.
+"""
+
+import numpy as np
+
+from datacollector import DynamicsSummary
+from space import GrassField
+
+
+class Count:
+    """Stands in for a scheduler with a fixed number of agents. """
+
+    def __init__(self, n, steps):
+        self.n = n
+        self.steps = steps
+
+    def get_agent_count(self):
+        """Returns the number of agents. """
+        return self.n
+
+
+class ReplicaState:
+    """Final state of one replica. Exposes the parts of the model used by
+    the model reporters: the schedulers, their counts and the total energy.
+    """
+
+    def __init__(self, steps, prey, predators, total_energy, dynamics=None):
+        """Create the state of a replica after steps steps, with the
+        statistics of its dynamics when the models summarize them.
+        """
+        self.schedule = Count(0, steps)
+        self.schedule_Prey = Count(prey, steps)
+        self.schedule_Predator = Count(predators, steps)
+        self.total_energy = total_energy
+        self.running = prey > 0 and predators > 0
+        self.dynamics = dynamics
+
+
+class Ensemble:
+    """Advances replicas of a PreyPredatorModel with the same parameters in
+    lockstep. A replica drops out of the arrays when prey or predators go
+    extinct, like a model which stops running.
+
+    The initial state of every replica is that of the model with its seed,
+    but the replicas share the random number generator of their steps, so
+    their runs are statistically, not exactly, equal to separate runs.
+    """
+
+    def __init__(self, model_cls, seeds, **kwargs):
+        """Create the replicas.
+
+        Args:
+            model_cls (type): Model class, for instance PreyPredatorModel.
+            seeds (list): Seed of each replica.
+            kwargs: Parameters of the model, shared by all replicas.
+        """
+        kwargs.update(vectorized=True, collect_data=False)
+        models = [model_cls(seed=seed, **kwargs) for seed in seeds]
+        self.size = len(models)
+
+        # The first model is stepped, with the animals and grass of all.
+        self.model = models[0]
+        self.model.deaths = None
+        self.engine = self.model.engine
+        self.engine.grouped = True
+        self.engine.rng = self.model.rng = np.random.default_rng(
+            None if None in seeds else [int(seed) for seed in seeds])
+
+        populations = {'Prey': self.engine.prey,
+                       'Predator': self.engine.predators}
+        for name, population in populations.items():
+            parts = [(part.positions.copy(), part.energy.copy()) for part in
+                     (getattr(model, f'schedule_{name}') for model in models)]
+            population.n = 0
+            for group, (positions, energy) in enumerate(parts):
+                population.add(positions, energy, group)
+
+        self.model.grass = GrassField(
+            self.model.space,
+            np.concatenate([model.grass.points for model in models]),
+            np.concatenate([model.grass.fully_grown for model in models]),
+            np.concatenate([model.grass.countdown for model in models]),
+            self.model.grass.regrowth_time,
+            np.repeat(np.arange(self.size),
+                      [len(model.grass) for model in models]))
+
+        self.summary = None
+        if self.model.summary is not None:
+            summary = self.model.summary
+            self.summary = DynamicsSummary(summary.points, summary.stride,
+                                           summary.max_lag, self.size)
+
+        self.active = np.ones(self.size, dtype=bool)
+        self.states = [None] * self.size
+        self.summarize()
+        self.drop_finished()
+
+    @property
+    def steps(self):
+        """Number of steps of the replicas which are still running. """
+        return self.model.schedule.steps
+
+    def counts(self, population, weights=None):
+        """Returns the number (or sum of weights) of animals per replica. """
+        return np.bincount(population.group, weights=weights,
+                           minlength=self.size)
+
+    def summarize(self):
+        """Add the animal counts of the running replicas to the summary. """
+        if self.summary is None:
+            return
+        counts = np.stack([self.counts(self.engine.prey),
+                           self.counts(self.engine.predators)], axis=1)
+        replicas = np.flatnonzero(self.active)
+        self.summary.update(self.steps, counts[replicas], replicas)
+
+    def drop_finished(self):
+        """Store the state of replicas in which prey or predators are
+        extinct, and remove their animals and grass from the arrays.
+        """
+        prey, predators = self.engine.prey, self.engine.predators
+        prey_counts = self.counts(prey)
+        predator_counts = self.counts(predators)
+        finished = self.active & ((prey_counts == 0) | (predator_counts == 0))
+        if np.any(finished):
+            self.store(finished)
+            for population in (prey, predators):
+                population.alive[finished[population.group]] = False
+                population.compact()
+            grass = self.model.grass
+            keep = ~finished[grass.groups]
+            self.model.grass = GrassField(
+                self.model.space, grass.points[keep], grass.fully_grown[keep],
+                grass.countdown[keep], grass.regrowth_time, grass.groups[keep])
+            self.active &= ~finished
+
+    def store(self, replicas):
+        """Store the current state of the replicas in boolean mask. """
+        prey, predators = self.engine.prey, self.engine.predators
+        prey_counts = self.counts(prey)
+        predator_counts = self.counts(predators)
+        prey_energy = self.counts(prey, prey.energy)
+        predator_energy = self.counts(predators, predators.energy)
+        for replica in np.flatnonzero(replicas):
+            self.states[replica] = ReplicaState(
+                self.steps, int(prey_counts[replica]),
+                int(predator_counts[replica]),
+                {'Prey': float(prey_energy[replica]),
+                 'Predator': float(predator_energy[replica])},
+                self.summary.statistics(replica)
+                if self.summary is not None else None)
+
+    def step(self):
+        """Perform a single time step for all running replicas. """
+        self.engine.step()
+        self.model.schedule.step()
+        self.summarize()
+        self.drop_finished()
+
+    def run(self, max_steps, model_reporters):
+        """Run until all replicas finished or max_steps steps.
+
+        Args:
+            max_steps (int): Maximum number of steps.
+            model_reporters (dict): Name and function of each reporter.
+
+        Returns:
+            List of the reporter values of every replica, as dictionaries.
+        """
+        while np.any(self.active) and self.steps < max_steps:
+            self.step()
+        self.store(self.active)
+        return [{name: reporter(state)
+                 for name, reporter in model_reporters.items()}
+                for state in self.states]
@@ -5,15 +5,19 @@ Core class: PreyPredatorModel
 
 """
 
+from collections import defaultdict
 import random
 
+import numpy as np
+
 from mesa import Model
-from mesa.time import BaseScheduler, RandomActivation
 
-from agents import Prey, Predator, Grass
-from datacollector import PreyPredatorCollector
-from space import OptimizedContinuousSpace
-from utils import move_coordinates
+from agents import Death, DeathBuffer, Prey, Predator
+from datacollector import DynamicsSummary, PreyPredatorCollector
+from engine import VectorizedEngine
+from scheduler import ArrayActivation
+from space import GrassField, OptimizedContinuousSpace
+from utils import BlockRandom
 
 
 class PreyPredatorModel(Model):
@@ -31,12 +35,51 @@ class PreyPredatorModel(Model):
                  predator_gain_from_food=20,
                  predator_reproduction_chance=0.05, predator_death_chance=0.02,
                  predator_reproduction_min=40, predator_food_search_max=40,
-                 predator_sight=40, predator_reach=25):
+                 predator_sight=40, predator_reach=25,
+                 batch_queries=False, vectorized=False, headless=None,
+                 death_buffer_size=1000, seed=None,
+                 data_path=None, data_stride=1, data_chunk_size=1024,
+                 summarize=False, summary_points=64, summary_stride=16,
+                 summary_max_lag=400):
         """Create new model with given parameters.
-        Initializes agents and schedulers. """
+        Initializes agents and schedulers.
+
+        With batch_queries, all prey move at once at the start of each step
+        (see move_prey), after which they eat, reproduce and die one by one.
+        This is much faster for large populations, but prey then react to
+        the positions and grass at the start of the step instead of to prey
+        which already moved or ate in the same step.
+
+        With vectorized, animals are not separate agents but are stored in
+        arrays, and each species moves, eats, reproduces and dies at once
+        (see engine.py). Population dynamics match the agent based model
+        statistically, at a fraction of the cost.
+
+        When headless (by default when not collecting data), deaths are
+        recorded in a ring buffer of death_buffer_size events instead of
+        creating Death agents for the visualization.
+
+        All randomness of a model is derived from seed, so runs with the same
+        seed are reproducible.
+
+        Collected data is kept for every data_stride-th step. With data_path,
+        it is streamed to that .npy file in chunks of data_chunk_size steps
+        instead of kept in memory; open it with
+        datacollector.load_model_vars.
+
+        With summarize, the population dynamics are summarized online in a
+        datacollector.DynamicsSummary, independent of collect_data: the
+        statistics of the prey and predator counts, their dominant period
+        and a trajectory of summary_points counts, summary_stride steps
+        apart. They are available in self.dynamics.
+        """
 
         super().__init__()
-        self.space = OptimizedContinuousSpace(width, height, torus=True)
+        self.init_random(seed)
+        # Cells of the spatial index are as large as the largest radius queried.
+        cell_size = max(prey_sight, prey_reach, predator_sight, predator_reach)
+        self.space = OptimizedContinuousSpace(
+            width, height, torus=True, cell_size=cell_size)
 
         self.grass_clusters = grass_clusters
         self.grass_cluster_size = grass_cluster_size
@@ -63,84 +106,244 @@ class PreyPredatorModel(Model):
         self.predator_sight = predator_sight
         self.predator_reach = predator_reach
 
-        self.schedule_Prey = RandomActivation(self)
-        self.schedule_Predator = RandomActivation(self)
-        self.schedule_Death = RandomActivation(self)
-        self.food_schedule = RandomActivation(self)
-        self.schedule = BaseScheduler(self)
+        self.batch_queries = batch_queries
+        self.prey_food = None
+
+        self.vectorized = vectorized
+        if self.vectorized:
+            self.engine = VectorizedEngine(self)
+            self.schedule_Prey = self.engine.prey
+            self.schedule_Predator = self.engine.predators
+        else:
+            self.schedule_Prey = ArrayActivation(self)
+            self.schedule_Predator = ArrayActivation(self)
+        # Deaths are only drawn, so their order does not matter. Shuffling
+        # them would change the activation order of the animals, which
+        # share scheduler_rng, depending on headless.
+        self.schedule_Death = ArrayActivation(self, shuffled=False)
+        self.schedule = ArrayActivation(self, shuffled=False)
+
+        # Sum of the energy of all animals of a species, kept up to date
+        # by the animals.
+        self.total_energy = {'Prey': 0, 'Predator': 0}
+
+        # Removed agents, recycled by new_agent to reduce allocations.
+        self.agent_pool = defaultdict(list)
 
         self.collect_data = collect_data
+        if headless is None:
+            headless = not collect_data
+        self.deaths = DeathBuffer(death_buffer_size) if headless else None
+
         if self.collect_data:
-            self.datacollector = PreyPredatorCollector()
+            self.datacollector = PreyPredatorCollector(
+                data_chunk_size, data_stride, data_path)
         self.init_population(Prey, initial_prey)
         self.init_population(Predator, initial_predator)
         self.generate_grass_clusters(
             self.grass_clusters, self.grass_cluster_size)
 
+        self.summary = None
+        if summarize:
+            self.summary = DynamicsSummary(
+                summary_points, summary_stride, summary_max_lag)
+            self.summarize()
+
         self.running = True
         if self.collect_data:
             self.datacollector.collect(self)
 
+    @property
+    def dynamics(self):
+        """Dictionary of the statistics of the population dynamics so far,
+        computed once per step however many reporters read it.
+        """
+        return self.summary.statistics()
+
+    def summarize(self):
+        """Add the animal counts of the current step to the summary. """
+        self.summary.update(self.schedule.steps, [
+            self.schedule_Prey.get_agent_count(),
+            self.schedule_Predator.get_agent_count()])
+
+    def init_random(self, seed=None):
+        """Method that creates the random number generators of the model.
+
+        Creates independent streams from the seed for the Mesa interface
+        (self.random), the activation order of the schedulers
+        (self.scheduler_rng), bulk sampling (self.rng) and for each species
+        of agents (self.random_streams), which draw their numbers in blocks.
+        """
+        seed_sequence = np.random.SeedSequence(seed)
+        self._seed = seed
+        random_seed, scheduler_seed, rng_seed, prey_seed, predator_seed = \
+            seed_sequence.spawn(5)
+        self.random = random.Random(int(random_seed.generate_state(1)[0]))
+        self.scheduler_rng = np.random.default_rng(scheduler_seed)
+        self.rng = np.random.default_rng(rng_seed)
+        self.random_streams = {
+            'Prey': BlockRandom(np.random.default_rng(prey_seed)),
+            'Predator': BlockRandom(np.random.default_rng(predator_seed)),
+        }
+
     def init_population(self, agent_type, n):
         """Method that provides an easy way of making a bunch of agents at once. """
-        for i in range(n):
-            x = random.randrange(self.space.width)
-            y = random.randrange(self.space.height)
+        xs = self.rng.integers(self.space.width, size=n).tolist()
+        ys = self.rng.integers(self.space.height, size=n).tolist()
+        positions = list(zip(xs, ys))
 
-            self.new_agent(agent_type, (x, y))
+        if self.vectorized:
+            self.engine.add(agent_type.__name__, positions)
+        else:
+            for pos in positions:
+                self.new_agent(agent_type, pos)
 
     def generate_grass_clusters(self, n_clusters=8, cluster_size=100):
         """Generate given amount of grass clusters. Uses gaussian distribution
         to sample grass around initial grass position.
+        All patches are sampled at once and stored in a static grass field.
         """
-        for _ in range(n_clusters):
-            cx = random.uniform(self.space.x_min, self.space.x_max)
-            cy = random.uniform(self.space.y_min, self.space.y_max)
-            for _ in range(cluster_size):
-                angle = random.uniform(0, 360)
-                distance = random.gauss(0, 50)
-                pos = move_coordinates(cx, cy, angle, distance)
-
-                fully_grown = random.choice([True, False])
-                if fully_grown:
-                    countdown = self.food_regrowth_time
-                else:
-                    countdown = random.randrange(self.food_regrowth_time)
-
-                agent = Grass(self.next_id(), self, pos, fully_grown, countdown)
-                self.space.place_agent(agent, pos)
-                self.food_schedule.add(agent)
+        rng = self.rng
+        shape = (n_clusters, cluster_size)
+
+        cx = rng.uniform(self.space.x_min, self.space.x_max, (n_clusters, 1))
+        cy = rng.uniform(self.space.y_min, self.space.y_max, (n_clusters, 1))
+        angles = np.radians(rng.uniform(0, 360, shape))
+        distances = rng.normal(0, 50, shape)
+        x = cx + distances * np.sin(angles)
+        y = cy + distances * np.cos(angles)
+        x = self.space.x_min + (x - self.space.x_min) % self.space.width
+        y = self.space.y_min + (y - self.space.y_min) % self.space.height
+        points = np.stack([x.ravel(), y.ravel()], axis=1)
+
+        fully_grown = rng.random(points.shape[0]) < 0.5
+        countdown = np.where(
+            fully_grown, self.food_regrowth_time,
+            rng.integers(0, self.food_regrowth_time, points.shape[0]))
+
+        self.grass = GrassField(self.space, points, fully_grown, countdown,
+                                self.food_regrowth_time)
 
     def new_agent(self, agent_type, pos, *args):
-        """Method that creates a new agent, and adds it to the correct scheduler. """
-        agent = agent_type(self.next_id(), self, pos, *args)
+        """Method that creates a new agent, and adds it to the correct scheduler.
+        Reuses a removed agent of the same type from the pool when available.
+        """
+        pool = self.agent_pool[agent_type]
+        if pool:
+            agent = pool.pop()
+            agent.__init__(self.next_id(), self, pos, *args)
+        else:
+            agent = agent_type(self.next_id(), self, pos, *args)
 
         self.space.place_agent(agent, pos)
         getattr(self, f'schedule_{agent_type.__name__}').add(agent)
 
+    def record_death(self, pos, animal_type):
+        """Method that records the death of an animal, in the death buffer
+        when headless and else as a new Death agent.
+        """
+        if self.deaths is not None:
+            self.deaths.append(pos, animal_type, self.schedule.steps)
+        else:
+            self.new_agent(Death, pos, animal_type)
+
     def remove_agent(self, agent):
         """Method that removes an agent from the space and the correct scheduler. """
+        name = type(agent).__name__
         self.space.remove_agent(agent)
-        getattr(self, f'schedule_{type(agent).__name__}').remove(agent)
+        getattr(self, f'schedule_{name}').remove(agent)
+        if name in self.total_energy:
+            self.total_energy[name] -= agent.energy
+        self.agent_pool[type(agent)].append(agent)
+
+    def compute_flock_vectors(self):
+        """Compute the flocking vectors of all prey with a few batched space
+        queries. Returns array of vectors, ordered as space.get_agents(Prey).
+        """
+        positions = self.space.get_points(Prey)
+        seperate_vectors_prey = self.space.get_vectors_to_agents(
+            positions, Prey, self.prey_reach)
+        seperate_vectors_predators = self.space.get_vectors_to_agents(
+            positions, Predator, self.prey_sight)
+        cohere_vectors = self.space.get_vectors_to_agents(
+            positions, Prey, self.prey_sight)
+        vectors = \
+            -1 * self.prey_separate_factor * seperate_vectors_prey + \
+            -1 * self.prey_separate_predators_factor * seperate_vectors_predators + \
+            self.prey_cohere_factor * cohere_vectors
+        return vectors
+
+    def move_prey(self):
+        """Move all prey at once with space.move_agents, as Prey.step moves
+        a single prey, from the positions and grass at the start of the step.
+        Returns dictionary of prey to the indices of the fully grown grass
+        within their reach before moving, which they may eat in their step.
+        """
+        prey = self.space.get_agents(Prey)
+        if not prey:
+            return {}
+        positions = self.space.get_points(Prey).copy()
+        grass = self.grass
+
+        q, g = self.space.neighbor_pairs(positions, grass.points, self.prey_reach)
+        grown = grass.fully_grown[g]
+        q, g = q[grown], g[grown]
+        counts = np.bincount(q, minlength=len(prey))
+        food = np.split(g, np.cumsum(counts)[:-1])
+
+        vectors = self.compute_flock_vectors()
+        energy = np.array([animal.energy for animal in prey])
+        hungry = (energy < self.prey_food_search_max) & (counts == 0)
+        if np.any(hungry):
+            vectors[hungry] += self.prey_hungry_factor * \
+                self.space.headings_to_points(
+                    positions[hungry], grass.points[grass.fully_grown],
+                    self.prey_sight, normalize=False)
+
+        # Prey without a heading move randomly, as in Animal.random_move.
+        directed = np.any(vectors != 0, axis=1)
+        angles = np.degrees(np.arctan2(vectors[:, 0], vectors[:, 1]))
+        distances = np.full(len(prey), 25.0)
+        n_random = len(prey) - int(np.count_nonzero(directed))
+        distances[~directed] = self.rng.uniform(0, 25, n_random)
+        angles[~directed] = self.rng.uniform(0, 360, n_random)
+        self.space.move_agents(prey, angles, distances)
+        return dict(zip(prey, food))
 
     def step(self):
         """Method that calls the step method for each of the agent types.
         """
-        self.schedule_Prey.step()
-        self.schedule_Predator.step()
-        self.schedule_Death.step()
-        self.food_schedule.step()
+        if self.vectorized:
+            self.engine.step()
+        else:
+            # Draw the random numbers of this step in one block per species.
+            for name, stream in self.random_streams.items():
+                stream.refill(
+                    4 * getattr(self, f'schedule_{name}').get_agent_count())
+            if self.batch_queries:
+                self.prey_food = self.move_prey()
+            self.schedule_Prey.step()
+            self.prey_food = None
+            self.schedule_Predator.step()
+            self.schedule_Death.step()
+            self.grass.step()
         self.schedule.step()
 
         # Save the statistics
         if self.collect_data:
             self.datacollector.collect(self)
+        if self.summary is not None:
+            self.summarize()
 
         if (self.schedule_Predator.get_agent_count() == 0 or
                 self.schedule_Prey.get_agent_count() == 0):
             self.running = False
+            if self.collect_data:
+                self.datacollector.flush()
 
     def run_model(self, step_count=200):
         """Method that runs the model for a specific amount of steps. """
         for i in range(step_count):
             self.step()
+        if self.collect_data:
+            self.datacollector.flush()
@@ -0,0 +1,140 @@
+"""
+Columnar storage of the results of a batch run.
+
+Core class: ResultsWriter
+
+A result set is a directory with:
+
+    metadata.json       config of the batch run, columns and partitions
+    samples.npy         Saltelli samples of the variable parameters
+    part-00000.npz      compressed column arrays of up to partition_size runs
+    ...
+
+Partitions are written as runs finish and metadata.json is replaced after
+every partition, so a result set can be read while it is being written.
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+class ResultsWriter:
+    """Writes the results of runs to a partitioned, columnar result set. """
+
+    def __init__(self, path, columns, metadata, samples=None,
+                 partition_size=4096):
+        """Create an empty result set, replacing the partitions of an
+        existing one in the same directory.
+
+        Args:
+            path (str): Directory of the result set.
+            columns (dict): Name and dtype of every column.
+            metadata (dict): Settings of the batch run, stored as JSON.
+            samples (ndarray): Saltelli samples of the variable parameters.
+            partition_size (int): Number of runs per partition.
+        """
+        self.path = path
+        self.columns = {name: np.dtype(dtype) for name, dtype in columns.items()}
+        self.metadata = metadata
+        self.partition_size = partition_size
+        self.partitions = []
+        self.n = 0
+        self._buffers = {name: np.empty(partition_size, dtype=dtype)
+                         for name, dtype in self.columns.items()}
+
+        os.makedirs(path, exist_ok=True)
+        for name in os.listdir(path):
+            if name.startswith('part-') and name.endswith('.npz'):
+                os.remove(os.path.join(path, name))
+        if samples is not None:
+            np.save(os.path.join(path, 'samples.npy'), samples)
+        self._write_metadata()
+
+    def _write_metadata(self):
+        """Replace metadata.json, atomically. """
+        metadata = {
+            'metadata': self.metadata,
+            'columns': {name: dtype.str for name, dtype in self.columns.items()},
+            'partitions': self.partitions,
+        }
+        tmp_path = os.path.join(self.path, 'metadata.json.tmp')
+        with open(tmp_path, 'w') as out_file:
+            json.dump(metadata, out_file, indent=2, default=to_json)
+        os.replace(tmp_path, os.path.join(self.path, 'metadata.json'))
+
+    def append(self, row):
+        """Add the values of a run, a dictionary with a value per column. """
+        for name, buffer in self._buffers.items():
+            buffer[self.n] = row[name]
+        self.n += 1
+        if self.n == self.partition_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered runs as a new partition. """
+        if self.n == 0:
+            return
+        name = f'part-{len(self.partitions):05d}.npz'
+        np.savez_compressed(
+            os.path.join(self.path, name),
+            **{column: buffer[:self.n] for column, buffer in self._buffers.items()})
+        self.partitions.append({'file': name, 'rows': self.n})
+        self.n = 0
+        self._write_metadata()
+
+    def close(self):
+        """Write the remaining runs and the metadata. """
+        self.flush()
+        self._write_metadata()
+
+
+def to_json(value):
+    """Converts numpy scalars, which json cannot serialize. """
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def load_metadata(path):
+    """Returns the metadata of the result set in directory path. """
+    with open(os.path.join(path, 'metadata.json')) as in_file:
+        return json.load(in_file)
+
+
+def load_samples(path):
+    """Returns the Saltelli samples of the result set in directory path. """
+    return np.load(os.path.join(path, 'samples.npy'))
+
+
+def load_columns(path, columns=None):
+    """Returns a dictionary of arrays of the columns of a result set.
+    Only the partitions listed in its metadata are read, and of those only
+    the requested columns.
+
+    Args:
+        path (str): Directory of the result set.
+        columns (list): Names of the columns to read, by default all.
+    """
+    metadata = load_metadata(path)
+    if columns is None:
+        columns = list(metadata['columns'])
+    parts = {name: [] for name in columns}
+    for partition in metadata['partitions']:
+        with np.load(os.path.join(path, partition['file'])) as data:
+            for name in columns:
+                parts[name].append(data[name])
+    return {name: np.concatenate(arrays) if arrays else
+            np.empty(0, dtype=metadata['columns'][name])
+            for name, arrays in parts.items()}
+
+
+def load_results(path, columns=None):
+    """Returns a DataFrame of the columns of a result set, sorted by run. """
+    data = load_columns(path, columns)
+    df = pd.DataFrame(data)
+    if 'Run' in df:
+        df = df.sort_values('Run', ignore_index=True)
+    return df
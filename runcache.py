@@ -0,0 +1,174 @@
+"""
+On-disk cache of the results of model runs, shared between batch runs.
+
+Core class: RunCache
+
+A run is identified by a hash of everything which determines its results:
+the model keyword arguments (including the seed), max_steps, the model
+reporters and the source code of the model.
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import sqlite3
+import sys
+import time
+
+from results import to_json
+
+
+def source_version(model_cls):
+    """Returns a hash of the source files of the model: the module of
+    model_cls and the modules in its directory it uses, directly or
+    through each other. Any change to the model invalidates the cache.
+    """
+    directory = os.path.dirname(os.path.abspath(inspect.getfile(model_cls)))
+
+    def local_module(value):
+        """Returns the module of value if it is defined in directory. """
+        module = value if inspect.ismodule(value) else \
+            sys.modules.get(getattr(value, '__module__', None) or '')
+        path = getattr(module, '__file__', None)
+        if path and os.path.dirname(os.path.abspath(path)) == directory:
+            return module
+        return None
+
+    modules = {}
+    todo = [sys.modules[model_cls.__module__]]
+    while todo:
+        module = todo.pop()
+        if module.__name__ in modules:
+            continue
+        modules[module.__name__] = module
+        for value in list(vars(module).values()):
+            used = local_module(value)
+            if used is not None:
+                todo.append(used)
+
+    digest = hashlib.sha256()
+    for name in sorted(modules):
+        with open(modules[name].__file__, 'rb') as source_file:
+            digest.update(name.encode())
+            digest.update(source_file.read())
+    return digest.hexdigest()
+
+
+def reporter_source(reporter):
+    """Returns the source code of a reporter, or its name if unavailable. """
+    try:
+        return inspect.getsource(reporter).strip()
+    except (OSError, TypeError):
+        return getattr(reporter, '__qualname__', repr(reporter))
+
+
+def run_key(version, kwargs, max_steps, model_reporters):
+    """Returns the cache key of a run.
+
+    Args:
+        version (str): Source version of the model, see source_version.
+        kwargs (dict): Keyword arguments of the model, including the seed.
+        max_steps (int): Maximum number of steps of the run.
+        model_reporters (dict): Name and function of the model reporters.
+    """
+    description = json.dumps({
+        'version': version,
+        'kwargs': kwargs,
+        'max_steps': max_steps,
+        'reporters': {name: reporter_source(reporter)
+                      for name, reporter in model_reporters.items()},
+    }, sort_keys=True, default=to_json)
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+class RunCache:
+    """Cache of the reporter values of runs in an SQLite database, which
+    evicts the least recently used runs when it exceeds max_bytes.
+
+    Keeps statistics of the lookups since it was opened.
+    """
+
+    def __init__(self, path, max_bytes=1 << 30):
+        """Open or create a cache.
+
+        Args:
+            path (str): Path of the database file.
+            max_bytes (int): Maximum total size of the cached values.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS runs (key TEXT PRIMARY KEY, '
+            'value_json TEXT, seconds REAL, size INTEGER, last_used REAL)')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS runs_last_used ON runs (last_used)')
+        self.connection.commit()
+        self.size = self.connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM runs').fetchone()[0]
+
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+        self.evictions = 0
+
+    def get(self, key):
+        """Returns (values, seconds) of a cached run, or None. """
+        row = self.connection.execute(
+            'SELECT value_json, seconds FROM runs WHERE key = ?',
+            (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.connection.execute(
+            'UPDATE runs SET last_used = ? WHERE key = ?', (time.time(), key))
+        self.hits += 1
+        self.seconds_saved += row[1] or 0
+        return json.loads(row[0]), row[1]
+
+    def put(self, key, values, seconds):
+        """Store the reporter values and run time of a run. """
+        value_json = json.dumps(values, default=to_json)
+        size = len(key) + len(value_json)
+        old = self.connection.execute(
+            'SELECT size FROM runs WHERE key = ?', (key,)).fetchone()
+        self.connection.execute(
+            'INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?)',
+            (key, value_json, seconds, size, time.time()))
+        self.size += size - (old[0] if old else 0)
+        if self.size > self.max_bytes:
+            self.evict()
+        self.connection.commit()
+
+    def evict(self):
+        """Remove the least recently used runs until the cache fits. """
+        while self.size > self.max_bytes:
+            rows = self.connection.execute(
+                'SELECT key, size FROM runs ORDER BY last_used LIMIT 256'
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.size <= self.max_bytes:
+                    break
+                self.connection.execute('DELETE FROM runs WHERE key = ?',
+                                        (key,))
+                self.size -= size
+                self.evictions += 1
+
+    def close(self):
+        """Write pending changes and close the database. """
+        self.connection.commit()
+        self.connection.close()
+
+    def summary(self):
+        """Returns a summary of the lookups since the cache was opened. """
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0
+        return (f'Run cache: {self.hits} of {lookups} runs cached '
+                f'({hit_rate:.1%}), {self.seconds_saved:.1f} s of CPU time '
+                f'saved, {self.evictions} runs evicted, '
+                f'{self.size / 2 ** 20:.1f} of {self.max_bytes / 2 ** 20:.1f} MB used')
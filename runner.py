@@ -5,19 +5,30 @@ Implements the script to run multiple simulations needed for analysis.
 import argparse
 from datetime import datetime
 import json
-import pickle
+import os
+
+from multiprocess import cpu_count
 
 from batchrunner import SobolBatchRunner
+from datacollector import DynamicsSummary
 from model import PreyPredatorModel
+from results import ResultsWriter, load_results
+from runcache import RunCache
+from workqueue import Coordinator, parse_address, run_workers
 
 
 def main(args):
+    if args.worker:
+        run_workers(parse_address(args.worker), args.authkey.encode(),
+                    args.processes or cpu_count(), args.connect_timeout)
+        return
+
     with open(args.config) as config_file:
         params = json.load(config_file)
 
     problem = {
         'num_vars': len(params['variable_params']),
-        'names': params['variable_params'].keys(),
+        'names': list(params['variable_params'].keys()),
         'bounds': list(params['variable_params'].values())
     }
 
@@ -28,32 +39,99 @@ def main(args):
     }
 
     params['fixed_params'].update({'collect_data': False})
-
-    batch = SobolBatchRunner(PreyPredatorModel,
-                             problem,
-                             args.distinct_samples,
-                             max_steps=args.max_steps,
-                             iterations=args.iterations,
-                             fixed_parameters=params['fixed_params'],
-                             model_reporters=model_reporters)
-
-    batch.run_all()
-
-    results = batch.get_model_vars_dataframe()
+    if args.dynamics:
+        # Spread the points of the trajectories over all steps.
+        stride = -(-args.max_steps // args.trajectory_points)
+        params['fixed_params'].update({
+            'summarize': True,
+            'summary_points': args.trajectory_points,
+            'summary_stride': stride,
+            # Lags beyond half the steps of a run are never used.
+            'summary_max_lag': max((args.max_steps + 1) // 2, 1),
+        })
+        model_reporters.update(
+            DynamicsSummary(args.trajectory_points, stride).reporters())
 
     out = args.out
     if not out:
+        if args.resume:
+            raise SystemExit('--resume needs the --out of the batch run')
         timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
         out = f'results_{timestamp}'
-
-    params.update({
-        'iterations': args.iterations,
-        'max_steps': args.max_steps,
-        'distinct_samples': args.distinct_samples
-    })
-
-    with open(out, 'wb') as out_file:
-        pickle.dump((params, results), out_file)
+    os.makedirs(out, exist_ok=True)
+
+    cache = None
+    if args.cache:
+        cache = RunCache(args.cache, int(args.cache_size * 2 ** 20))
+
+    coordinator = None
+    try:
+        batch = SobolBatchRunner(PreyPredatorModel,
+                                 problem,
+                                 args.distinct_samples,
+                                 max_steps=args.max_steps,
+                                 iterations=args.iterations,
+                                 fixed_parameters=params['fixed_params'],
+                                 model_reporters=model_reporters,
+                                 seed=args.seed,
+                                 store_path=os.path.join(out, 'runs.jsonl'),
+                                 resume=args.resume,
+                                 common_random_numbers=args.crn,
+                                 cache=cache,
+                                 ensemble=args.ensemble,
+                                 processes=args.processes)
+
+        if args.serve:
+            coordinator = Coordinator(parse_address(args.serve),
+                                      args.authkey.encode(),
+                                      args.lease_timeout)
+
+        params.update({
+            'problem': problem,
+            'iterations': args.iterations,
+            'max_steps': args.max_steps,
+            'distinct_samples': args.distinct_samples,
+            'seed': batch.seed,
+            'common_random_numbers': args.crn,
+            'ensemble': args.ensemble
+        })
+        writer = ResultsWriter(out, batch.result_columns(), params,
+                               samples=batch.param_values)
+        try:
+            outputs = {
+                'Prey survives': lambda r: r['Prey'] > 0,
+                'Predator survives': lambda r: r['Predator'] > 0,
+            }
+            samples = None
+            if args.tolerance is not None:
+                batch.run_adaptive(outputs, args.tolerance, args.min_samples,
+                                   coordinator, writer)
+                params['rounds'] = batch.rounds
+                samples = batch.rounds[-1]['samples']
+            else:
+                batch.run_all(coordinator, writer)
+
+            if args.iteration_report:
+                report, needed = batch.iteration_report(outputs, samples)
+                print('Largest confidence interval (+/-) of the Sobol '
+                      'indices:')
+                print(report.to_string())
+                print('Iterations needed for the same confidence:', needed)
+                params['iteration_report'] = {
+                    'confidence': report.to_dict(orient='list'),
+                    'needed': needed}
+        finally:
+            # Also on errors and interrupts, so the result set lists the
+            # partitions written so far.
+            writer.close()
+    finally:
+        # The workers exit once the coordinator is closed.
+        if coordinator is not None:
+            coordinator.close()
+        if cache is not None:
+            cache.close()
+
+    results = load_results(out)
 
     return problem, results
 
@@ -63,7 +141,44 @@ if __name__ == '__main__':
     parser.add_argument('--iterations', default=10, type=int)
     parser.add_argument('--max_steps', default=1000, type=int)
     parser.add_argument('--distinct_samples', default=512, type=int)
+    parser.add_argument('--tolerance', type=float,
+                        help='run samples in powers of two, until the confidence '
+                             'intervals of the Sobol indices are this narrow')
+    parser.add_argument('--min_samples', default=8, type=int)
+    parser.add_argument('--crn', action='store_true',
+                        help='share seeds between the runs of a Saltelli sample')
+    parser.add_argument('--ensemble', action='store_true',
+                        help='run the iterations of a sample in lockstep as one '
+                             'vectorized ensemble')
+    parser.add_argument('--iteration_report', action='store_true',
+                        help='report the iterations needed for the confidence '
+                             'of the Sobol indices')
+    parser.add_argument('--dynamics', action='store_true',
+                        help='also store statistics and a downsampled trajectory '
+                             'of the prey and predator counts of every run')
+    parser.add_argument('--trajectory_points', default=64, type=int)
+    parser.add_argument('--cache', type=str, metavar='PATH',
+                        help='reuse the results of runs cached in this file')
+    parser.add_argument('--cache_size', default=1024, type=float,
+                        help='maximum size of the cache in MB')
+    parser.add_argument('--seed', type=int)
     parser.add_argument('--out', type=str)
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the runs already stored in OUT/runs.jsonl')
+    parser.add_argument('--serve', type=str, metavar='HOST:PORT',
+                        help='serve the runs to workers instead of running them')
+    parser.add_argument('--worker', type=str, metavar='HOST:PORT',
+                        help='run the runs served by a coordinator')
+    parser.add_argument('--authkey', type=str,
+                        help='key shared by the coordinator and its workers')
+    parser.add_argument('--lease_timeout', default=600, type=float)
+    parser.add_argument('--connect_timeout', default=600, type=float,
+                        help='seconds a worker waits for the coordinator to start')
+    parser.add_argument('--processes', type=int,
+                        help='number of worker processes, by default one per '
+                             'CPU; with --serve, the workers set their own')
     args = parser.parse_args()
+    if (args.serve or args.worker) and not args.authkey:
+        parser.error('--serve and --worker need an --authkey')
 
     main(args)
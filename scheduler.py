@@ -0,0 +1,98 @@
+"""
+Scheduler class
+
+Core class: ArrayActivation
+
+"""
+
+import numpy as np
+
+
+class ArrayActivation:
+    """Scheduler which activates each agent once per step in random order,
+    like mesa.time.RandomActivation.
+
+    Agents are stored in a dense object array with a tombstone mask, so
+    adding and removing agents are O(1), also while the agents are being
+    stepped. Removed slots are compacted at the start of a step once they
+    make up half of the array. The activation order is a numpy permutation.
+    """
+
+    def __init__(self, model, shuffled=True):
+        """Create a new, empty scheduler.
+
+        Args:
+            model (Model): Model with scheduler_rng, used to shuffle agents.
+            shuffled (bool): Activate agents in random order every step,
+                else in the order they were added.
+        """
+        self.model = model
+        self.shuffled = shuffled
+        self.steps = 0
+        self.time = 0
+        self.n = 0
+        self._count = 0
+        self._agents = np.empty(16, dtype=object)
+        self._alive = np.zeros(16, dtype=bool)
+        self._agent_to_index = {}
+
+    def add(self, agent):
+        """Add an agent to the schedule. """
+        if agent in self._agent_to_index:
+            raise Exception(
+                f'Agent with unique id {agent.unique_id!r} already added to scheduler')
+        if self.n == len(self._agents):
+            self._agents = np.resize(self._agents, 2 * self.n)
+            self._alive = np.resize(self._alive, 2 * self.n)
+        self._agents[self.n] = agent
+        self._alive[self.n] = True
+        self._agent_to_index[agent] = self.n
+        self.n += 1
+        self._count += 1
+
+    def remove(self, agent):
+        """Remove an agent from the schedule, leaving a tombstone. """
+        index = self._agent_to_index.pop(agent)
+        self._agents[index] = None
+        self._alive[index] = False
+        self._count -= 1
+
+    def compact(self):
+        """Remove the tombstones of removed agents. """
+        agents = self.agent_array
+        self.n = len(agents)
+        self._agents[:self.n] = agents
+        self._agents[self.n:] = None
+        self._alive[:self.n] = True
+        self._alive[self.n:] = False
+        self._agent_to_index = dict(zip(agents.tolist(), range(self.n)))
+
+    def step(self):
+        """Execute the step of all agents, one at a time. Agents added during
+        the step are not activated, agents removed during it are skipped.
+        """
+        if self.n > 2 * self._count:
+            self.compact()
+        if self.shuffled:
+            order = self.model.scheduler_rng.permutation(self.n)
+        else:
+            order = np.arange(self.n)
+        for index, agent in zip(order.tolist(), self._agents[order].tolist()):
+            if self._alive[index]:
+                agent.step()
+        self.steps += 1
+        self.time += 1
+
+    def get_agent_count(self):
+        """Returns the current number of agents in the schedule. """
+        return self._count
+
+    @property
+    def agent_array(self):
+        """Object array of all agents in the schedule. """
+        return self._agents[:self.n][self._alive[:self.n]]
+
+    @property
+    def agents(self):
+        """List of all agents in the schedule. """
+        return self.agent_array.tolist()
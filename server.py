@@ -8,7 +8,7 @@ from mesa.visualization.modules import ChartModule
 from mesa.visualization.ModularVisualization import ModularServer
 from mesa.visualization.UserParam import UserSettableParameter
 
-from agents import Death, Prey, Predator, Grass
+from agents import Death, Prey, Predator
 from model import PreyPredatorModel
 from visualization import CanvasContinuous
 
@@ -23,40 +23,47 @@ def animal_portrayal(color):
         's': 2
     }
 
+def death_portrayal(animal_type, duration):
+    """Returns visualization properties of a death, duration time steps ago. """
+    opacity = (10 - duration)/10
+    rgb = '237, 58, 28' if animal_type == 'Predator' else '0, 24, 248'
+    return {
+        'Shape': 'cross',
+        'Color': f'rgba({rgb}, {opacity})',
+        'Filled': 'true',
+        'Layer': 1,
+        'r': 5,
+        's': 2
+    }
+
 def agent_portrayal(agent):
     """Returns visualization properties of agents. """
     if isinstance(agent, Death):
-        opacity = (10 - agent.duration)/10
-        rgb = '237, 58, 28' if agent.animal_type == 'Predator' else '0, 24, 248'
-        return {
-            'Shape': 'cross',
-            'Color': f'rgba({rgb}, {opacity})',
-            'Filled': 'true',
-            'Layer': 1,
-            'r': 5,
-            's': 2
-        }
+        return death_portrayal(agent.animal_type, agent.duration)
     elif isinstance(agent, Prey):
         return animal_portrayal('blue')
     elif isinstance(agent, Predator):
         return animal_portrayal('red')
-    elif isinstance(agent, Grass):
-        if agent.fully_grown:
-            color = 'rgb(0, 150, 0)'
-        else:
-            growth_time = agent.model.food_regrowth_time
-            opacity = (growth_time-agent.countdown)/growth_time
-            color = f'rgba(0, 150, 0, {opacity})'
-        return {
-            'Shape': 'circle',
-            'Color': color,
-            'Filled': 'true',
-            'Layer': 0,
-            'r': 10
-        }
+
+def grass_portrayal(grass, index):
+    """Returns visualization properties of a patch of grass. """
+    if grass.fully_grown[index]:
+        color = 'rgb(0, 150, 0)'
+    else:
+        growth_time = grass.regrowth_time
+        opacity = (growth_time-grass.countdown[index])/growth_time
+        color = f'rgba(0, 150, 0, {opacity})'
+    return {
+        'Shape': 'circle',
+        'Color': color,
+        'Filled': 'true',
+        'Layer': 0,
+        'r': 10
+    }
 
 # Create a 500 by 500 pixels canvas for the space
-grid = CanvasContinuous(agent_portrayal, 500, 500)
+grid = CanvasContinuous(agent_portrayal, 500, 500, grass_portrayal,
+                        death_portrayal)
 
 # Create a dynamic linegraph
 population_chart = ChartModule([{
@@ -1,45 +1,261 @@
 """
-Space class
+Space classes
 
-Core class: OptimizedContinuousSpace
+Core classes: OptimizedContinuousSpace, GrassField
 
 """
 
 from collections import defaultdict
+from itertools import chain
+import math
+
 import numpy as np
 
 from mesa.space import ContinuousSpace
 
+# Types with at most this many agents are scanned without the cell list.
+SCAN_THRESHOLD = 256
+
 
 class OptimizedContinuousSpace(ContinuousSpace):
-    """Extends ContinuousSpace for better efficiency using numpy """
+    """Extends ContinuousSpace for better efficiency using numpy.
+
+    Agent positions are stored per agent type in dense slot arrays. Removing
+    an agent moves the last agent of the same type into the freed slot, so
+    adding and removing agents are amortized O(1).
+
+    Every slot is also registered in a uniform grid of cells (a cell list),
+    so radius queries only look at agents in cells close to the position.
+    The cell size should be at least the largest radius queried.
+    """
 
-    def __init__(self, x_max, y_max, torus, x_min=0, y_min=0):
-        """Create new space. """
+    def __init__(self, x_max, y_max, torus, x_min=0, y_min=0, cell_size=None):
+        """Create new space.
+
+        Args:
+            cell_size (float): Minimal size of a cell in the cell list.
+                Defaults to a single cell covering the whole space.
+        """
         super().__init__(x_max, y_max, torus, x_min, y_min)
-        self._type_to_indices = defaultdict(list)
+        self._type_to_points = {}
+        self._type_to_agents = defaultdict(list)
+
+        if not cell_size:
+            cell_size = max(self.width, self.height)
+        self.n_cells_x = max(1, int(self.width // cell_size))
+        self.n_cells_y = max(1, int(self.height // cell_size))
+        self.cell_width = self.width / self.n_cells_x
+        self.cell_height = self.height / self.n_cells_y
+        self._type_to_cells = {}
+        self._type_to_buckets = defaultdict(lambda: defaultdict(set))
+        self._neighborhoods = {}
+        self._neighbor_counts = {}
+
+    def _cell(self, pos):
+        """Return the id of the cell containing a position. """
+        cx = min(int((pos[0] - self.x_min) / self.cell_width), self.n_cells_x - 1)
+        cy = min(int((pos[1] - self.y_min) / self.cell_height), self.n_cells_y - 1)
+        return cy * self.n_cells_x + cx
+
+    def _cell_range(self, c, k, n):
+        """Return cell coordinates within k cells of c along one axis. """
+        if 2 * k + 1 >= n:
+            return range(n)
+        if self.torus:
+            return [(c + d) % n for d in range(-k, k + 1)]
+        return range(max(c - k, 0), min(c + k + 1, n))
+
+    def _neighborhood(self, cell, radius):
+        """Return ids of all cells within radius of a cell, or None when
+        that covers the whole space.
+        """
+        kx = math.ceil(radius / self.cell_width)
+        ky = math.ceil(radius / self.cell_height)
+        key = (cell, kx, ky)
+        if key not in self._neighborhoods:
+            cx, cy = cell % self.n_cells_x, cell // self.n_cells_x
+            xs = self._cell_range(cx, kx, self.n_cells_x)
+            ys = self._cell_range(cy, ky, self.n_cells_y)
+            if len(xs) == self.n_cells_x and len(ys) == self.n_cells_y:
+                cells = None
+            else:
+                cells = [y * self.n_cells_x + x for y in ys for x in xs]
+            self._neighborhoods[key] = cells
+        return self._neighborhoods[key]
+
+    def _candidates(self, agent_type_name, pos, radius):
+        """Return slots of all agents of a type in cells near a position,
+        or None when all agents of the type are candidates.
+        """
+        # Scanning a few agents directly is cheaper than visiting cells.
+        if len(self._type_to_agents[agent_type_name]) <= SCAN_THRESHOLD:
+            return None
+        cells = self._neighborhood(self._cell(pos), radius)
+        if cells is None:
+            return None
+        buckets = self._type_to_buckets[agent_type_name]
+        slots = chain.from_iterable(buckets[c] for c in cells if c in buckets)
+        return np.fromiter(slots, dtype=int)
+
+    def _query(self, pos, agent_type_name, radius):
+        """Return slots and positions of agents of a type within radius. """
+        points = self._points_of_type(agent_type_name)
+        slots = self._candidates(agent_type_name, pos, radius)
+        if slots is not None:
+            points = points[slots]
+        (idxs,) = np.where(self._distances(pos, points) <= radius ** 2)
+        if slots is not None:
+            return slots[idxs], points[idxs]
+        return idxs, points[idxs]
+
+    def _points_of_type(self, agent_type_name):
+        """Return view on the positions of all agents of a type. """
+        n = len(self._type_to_agents[agent_type_name])
+        if not n:
+            return np.empty((0, 2))
+        return self._type_to_points[agent_type_name][:n]
 
     def place_agent(self, agent, pos):
         """Place a new agent in the space. """
-        super().place_agent(agent, pos)
+        pos = self.torus_adj(pos)
+        name = agent.__class__.__name__
+        agents = self._type_to_agents[name]
+        points = self._type_to_points.get(name)
+        cells = self._type_to_cells.get(name)
+        index = len(agents)
+        if points is None:
+            points = self._type_to_points[name] = np.empty((16, 2))
+            cells = self._type_to_cells[name] = np.empty(16, dtype=int)
+        elif index == points.shape[0]:
+            # Grow geometrically to keep appends amortized O(1).
+            points = self._type_to_points[name] = np.resize(
+                points, (2 * index, 2))
+            cells = self._type_to_cells[name] = np.resize(cells, 2 * index)
+        points[index] = pos
+        cell = cells[index] = self._cell(pos)
+        self._type_to_buckets[name][cell].add(index)
+        agents.append(agent)
+        self._agent_to_index[agent] = index
+        agent.pos = pos
         agent.last_pos = pos
-        index = self._agent_points.shape[0] - 1
-        self._type_to_indices[agent.__class__.__name__].append(index)
+        if self._neighbor_counts:
+            self._clear_neighbor_counts(name)
 
     def move_agent(self, agent, pos):
-         """Move an agent from its current position to a new position. """
-         agent.last_pos = agent.pos
-         super().move_agent(agent, pos)
+        """Move an agent from its current position to a new position. """
+        agent.last_pos = agent.pos
+        pos = self.torus_adj(pos)
+        name = agent.__class__.__name__
+        index = self._agent_to_index[agent]
+        self._type_to_points[name][index] = pos
+        cells = self._type_to_cells[name]
+        cell = self._cell(pos)
+        if cell != cells[index]:
+            buckets = self._type_to_buckets[name]
+            buckets[cells[index]].discard(index)
+            buckets[cell].add(index)
+            cells[index] = cell
+        agent.pos = pos
+        if self._neighbor_counts:
+            self._clear_neighbor_counts(name)
+
+    def move_agents(self, agents_or_indices, angles, distances, agent_type=None):
+        """Move many agents of the same type at once, each a distance towards
+        an angle, as move_agent does with utils.move_coordinates.
+
+        Args:
+            agents_or_indices: List of agents, or array of slots of agents
+                of agent_type (see get_agents). Each agent at most once.
+            angles (ndarray): Angles in degrees.
+            distances (ndarray): Distances to move.
+            agent_type (Agent): Type of the agents, required with slots.
+        """
+        if agent_type is None:
+            agents = list(agents_or_indices)
+            if not agents:
+                return
+            name = agents[0].__class__.__name__
+            slots = np.fromiter((self._agent_to_index[agent] for agent in agents),
+                                dtype=int, count=len(agents))
+        else:
+            name = agent_type.__name__
+            slots = np.asarray(agents_or_indices, dtype=int)
+            agents = [self._type_to_agents[name][i] for i in slots]
+
+        points = self._type_to_points[name]
+        angles = np.radians(angles)
+        new = points[slots] + np.stack(
+            [distances * np.sin(angles), distances * np.cos(angles)], axis=1)
+        if self.torus:
+            new[:, 0] = self.x_min + (new[:, 0] - self.x_min) % self.width
+            new[:, 1] = self.y_min + (new[:, 1] - self.y_min) % self.height
+        elif np.any((new[:, 0] < self.x_min) | (new[:, 0] >= self.x_max) |
+                    (new[:, 1] < self.y_min) | (new[:, 1] >= self.y_max)):
+            raise Exception("Point out of bounds, and space non-toroidal.")
+        points[slots] = new
+
+        # Only agents which changed cell need their bucket updated.
+        cx, cy = self._cell_coordinates(new)
+        new_cells = cy * self.n_cells_x + cx
+        cells = self._type_to_cells[name]
+        buckets = self._type_to_buckets[name]
+        (changed,) = np.where(new_cells != cells[slots])
+        for index, cell in zip(slots[changed].tolist(), new_cells[changed].tolist()):
+            buckets[cells[index]].discard(index)
+            buckets[cell].add(index)
+            cells[index] = cell
+
+        for agent, pos in zip(agents, new.tolist()):
+            agent.last_pos = agent.pos
+            agent.pos = tuple(pos)
+        if self._neighbor_counts:
+            self._clear_neighbor_counts(name)
 
     def remove_agent(self, agent):
         """Remove an agent from the simulation. """
-        idx = self._agent_to_index[agent]
-        self._type_to_indices[agent.__class__.__name__].remove(idx)
-        super().remove_agent(agent)
-        for t in self._type_to_indices:
-            for i, index in enumerate(self._type_to_indices[t]):
-                if index > idx:
-                    self._type_to_indices[t][i] -= 1
+        if agent not in self._agent_to_index:
+            raise Exception("Agent does not exist in the space")
+        name = agent.__class__.__name__
+        index = self._agent_to_index.pop(agent)
+        agents = self._type_to_agents[name]
+        cells = self._type_to_cells[name]
+        buckets = self._type_to_buckets[name]
+        last = agents.pop()
+        last_index = len(agents)
+        buckets[cells[index]].discard(index)
+        if last is not agent:
+            # Fill the freed slot with the last agent of this type.
+            points = self._type_to_points[name]
+            points[index] = points[last_index]
+            buckets[cells[last_index]].discard(last_index)
+            buckets[cells[last_index]].add(index)
+            cells[index] = cells[last_index]
+            agents[index] = last
+            self._agent_to_index[last] = index
+        agent.pos = None
+        for (type_name, _), cache in self._neighbor_counts.items():
+            if type_name == name:
+                agent_index, counts, indptr, neighbors = cache
+                i = agent_index.pop(agent)
+                counts[neighbors[indptr[i]:indptr[i + 1]]] -= 1
+
+    def get_neighbors(self, pos, radius, include_center=True):
+        """Get all agents within a radius, regardless of their type. """
+        neighbors = []
+        for name in self._type_to_agents:
+            slots, points = self._query(pos, name, radius)
+            if not include_center:
+                slots = slots[self._distances(pos, points) > 0]
+            agents = self._type_to_agents[name]
+            neighbors.extend(agents[i] for i in slots)
+        return neighbors
+
+    def _distances(self, pos, points):
+        """Squared distances from a position to a list of points. """
+        deltas = np.abs(points - np.array(pos))
+        if self.torus:
+            deltas = np.minimum(deltas, self.size - deltas)
+        return deltas[:, 0] ** 2 + deltas[:, 1] ** 2
 
     def calculate_heading(self, pos, points):
         """ Calculate vector from list of points. """
@@ -52,18 +268,9 @@ class OptimizedContinuousSpace(ContinuousSpace):
 
     def get_vector_to_agents(self, pos, agent_type, radius):
         """ Calculate vector from parameters agent type and a radius. """
-        # get points of agent type
-        agent_type_indices = self._type_to_indices[agent_type.__name__]
-        points_of_type = self._agent_points[agent_type_indices]
-
-        # get points within radius
+        # get points of agent type within radius
         pos = np.array(pos)
-        deltas = np.abs(points_of_type - pos)
-        if self.torus:
-            deltas = np.minimum(deltas, self.size - deltas)
-        dists = deltas[:, 0] ** 2 + deltas[:, 1] ** 2
-        (idxs,) = np.where(dists <= radius ** 2)
-        in_radius = points_of_type[idxs]
+        _, in_radius = self._query(pos, agent_type.__name__, radius)
         heading = self.calculate_heading(pos, in_radius)
         norm = np.linalg.norm(heading)
         if norm:
@@ -72,21 +279,264 @@ class OptimizedContinuousSpace(ContinuousSpace):
 
     def get_agent_neighbors(self, pos, agent_type, radius):
         """ Get list of agents of a certain agent type and within a radius. """
-        # get points of agent type
-        agent_type_indices = self._type_to_indices[agent_type.__name__]
-        points_of_type = self._agent_points[agent_type_indices]
+        # get slots of agent type within radius
+        name = agent_type.__name__
+        slots, _ = self._query(pos, name, radius)
+        agents = self._type_to_agents[name]
+        return [agents[i] for i in slots]
 
-        # get points within radius
-        pos = np.array(pos)
-        deltas = np.abs(points_of_type - pos)
+    def get_agents(self, agent_type):
+        """Return the agents of a type, ordered by their slot. """
+        return list(self._type_to_agents[agent_type.__name__])
+
+    def get_points(self, agent_type):
+        """Return the positions of the agents of a type, ordered by slot.
+        The array is a view which changes when agents move or are removed.
+        """
+        return self._points_of_type(agent_type.__name__)
+
+    def _cell_coordinates(self, points):
+        """Return cell coordinates of an array of points. """
+        cx = ((points[:, 0] - self.x_min) / self.cell_width).astype(int)
+        cy = ((points[:, 1] - self.y_min) / self.cell_height).astype(int)
+        return (np.clip(cx, 0, self.n_cells_x - 1),
+                np.clip(cy, 0, self.n_cells_y - 1))
+
+    def _axis_offsets(self, k, n):
+        """Return cell offsets to visit along one axis for k cells. """
+        if 2 * k + 1 >= n:
+            if self.torus:
+                return range(n)
+            return range(-n + 1, n)
+        return range(-k, k + 1)
+
+    def neighbor_pairs(self, positions, points, radius, groups=None):
+        """Find all pairs of positions and points within radius of each other.
+
+        Points are sorted by cell, after which the candidate pairs of all
+        positions and the points in their neighboring cells are generated
+        at once.
+
+        Args:
+            positions (ndarray): (m, 2) array of query positions.
+            points (ndarray): (n, 2) array of points.
+            radius (float): maximum distance of a pair.
+            groups (tuple): Optional tuple of integer arrays (position
+                groups, point groups). Only pairs in the same group are
+                found, as if every group is in a separate space.
+
+        Returns:
+            Tuple of arrays (query index, point index), sorted by query index.
+        """
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        if not len(positions) or not len(points):
+            return np.empty(0, dtype=int), np.empty(0, dtype=int)
+
+        nx, ny = self.n_cells_x, self.n_cells_y
+        px, py = self._cell_coordinates(points)
+        point_cells = py * nx + px
+        n_groups = 1
+        if groups is not None:
+            # Every group gets its own range of cells.
+            position_groups, point_groups = groups
+            n_groups = int(max(position_groups.max(), point_groups.max())) + 1
+            point_cells += point_groups * (nx * ny)
+        order = np.argsort(point_cells, kind='stable')
+        counts = np.bincount(point_cells, minlength=n_groups * nx * ny)
+        starts = np.cumsum(counts) - counts
+        sorted_points = points[order]
+
+        # Cells to visit for every query, one row per query.
+        kx = math.ceil(radius / self.cell_width)
+        ky = math.ceil(radius / self.cell_height)
+        dy, dx = np.meshgrid(self._axis_offsets(ky, ny),
+                             self._axis_offsets(kx, nx), indexing='ij')
+        qx, qy = self._cell_coordinates(positions)
+        cx = qx[:, None] + dx.ravel()
+        cy = qy[:, None] + dy.ravel()
+        queries = np.repeat(np.arange(len(positions)), dx.size)
         if self.torus:
-            deltas = np.minimum(deltas, self.size - deltas)
-        dists = deltas[:, 0] ** 2 + deltas[:, 1] ** 2
-        (idxs,) = np.where(dists <= radius ** 2)
-        return [self._index_to_agent[i] for i in np.array(agent_type_indices)[idxs]]
+            cells = cy % ny * nx + cx % nx
+        else:
+            cells = cy * nx + cx
+        if groups is not None:
+            cells += position_groups[:, None] * (nx * ny)
+        cells = cells.ravel()
+        if not self.torus:
+            valid = ((cx >= 0) & (cx < nx) & (cy >= 0) & (cy < ny)).ravel()
+            queries = queries[valid]
+            cells = cells[valid]
+
+        # Expand every (query, cell) combination to the points in that cell.
+        n_candidates = counts[cells]
+        q = np.repeat(queries, n_candidates)
+        first = np.repeat(starts[cells] - (np.cumsum(n_candidates) - n_candidates),
+                          n_candidates)
+        p = first + np.arange(len(q))
+
+        dx = np.abs(sorted_points[p, 0] - positions[q, 0])
+        dy = np.abs(sorted_points[p, 1] - positions[q, 1])
+        if self.torus:
+            dx = np.minimum(dx, self.width - dx)
+            dy = np.minimum(dy, self.height - dy)
+        within = dx * dx + dy * dy <= radius ** 2
+        return q[within], order[p[within]]
+
+    def get_neighbor_lists(self, positions, agent_type, radius):
+        """Get the agents of a type within radius of each of the positions.
+
+        Returns:
+            Neighbor lists in CSR form, a tuple (indptr, slots). The slots of
+            the agents near positions[i] are slots[indptr[i]:indptr[i + 1]],
+            see get_agents for the agent in each slot.
+        """
+        points = self._points_of_type(agent_type.__name__)
+        q, p = self.neighbor_pairs(positions, points, radius)
+        indptr = np.zeros(len(positions) + 1, dtype=int)
+        np.cumsum(np.bincount(q, minlength=len(positions)), out=indptr[1:])
+        return indptr, p
+
+    def headings_to_points(self, positions, points, radius, normalize=True,
+                           groups=None):
+        """Calculate the heading vectors to points within radius for each of
+        the positions, equal to calling calculate_heading for each position.
+        See neighbor_pairs for groups.
+        """
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        q, p = self.neighbor_pairs(positions, points, radius, groups)
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        if self.torus:
+            # Shift both sides like calculate_heading does.
+            points = (points - self.center) % self.size
+            positions = (positions - self.center) % self.size
+        vectors = points[p] - positions[q]
+        headings = np.stack([
+            np.bincount(q, weights=vectors[:, 0], minlength=len(positions)),
+            np.bincount(q, weights=vectors[:, 1], minlength=len(positions)),
+        ], axis=1).astype(float, copy=False)
+        if normalize:
+            norms = np.linalg.norm(headings, axis=1)
+            nonzero = norms > 0
+            headings[nonzero] /= norms[nonzero, None]
+        return headings
+
+    def get_vectors_to_agents(self, positions, agent_type, radius):
+        """Calculate get_vector_to_agents for many positions at once. """
+        points = self._points_of_type(agent_type.__name__)
+        return self.headings_to_points(positions, points, radius)
+
+    def count_neighbors(self, agent, radius):
+        """Return the number of agents of the same type within radius of an
+        agent, including the agent itself.
+
+        The counts of all agents of the type are computed at once and cached
+        until an agent of that type is placed or moved. Removing an agent
+        only decrements the counts of its neighbors.
+        """
+        name = agent.__class__.__name__
+        key = (name, radius)
+        if key not in self._neighbor_counts:
+            agents = self._type_to_agents[name]
+            indptr, neighbors = self.get_neighbor_lists(
+                self._points_of_type(name), agent.__class__, radius)
+            agent_index = {a: i for i, a in enumerate(agents)}
+            self._neighbor_counts[key] = (
+                agent_index, np.diff(indptr), indptr, neighbors)
+        agent_index, counts, _, _ = self._neighbor_counts[key]
+        return counts[agent_index[agent]]
+
+    def _clear_neighbor_counts(self, agent_type_name):
+        """Remove cached neighbor counts of an agent type. """
+        for key in list(self._neighbor_counts):
+            if key[0] == agent_type_name:
+                del self._neighbor_counts[key]
 
     def get_heading_to_agents(self, pos, agents):
         """ Calculate vector from a list of agents """
-        agent_indices = [self._agent_to_index[agent] for agent in agents]
-        points = self._agent_points[agent_indices]
+        points = np.array([agent.pos for agent in agents]).reshape(-1, 2)
         return self.calculate_heading(np.array(pos), points)
+
+
+class GrassField:
+    """Static spatial index of grass patches, the food source of prey.
+
+    Grass never moves, so the patches are sorted by the cells of the space
+    once and the candidate patches near each cell are cached. Growth state
+    is kept in a boolean fully grown mask and a countdown array, which are
+    updated for all patches at once.
+    """
+
+    def __init__(self, space, points, fully_grown, countdown, regrowth_time,
+                 groups=None):
+        """Create a grass field.
+
+        Args:
+            space (OptimizedContinuousSpace): Space the grass lies in.
+            points (ndarray): (n, 2) array of grass positions.
+            fully_grown (ndarray): Boolean array if grass is fully grown.
+            countdown (ndarray): Timesteps until grass will be fully grown.
+            regrowth_time (int): Timesteps for eaten grass to regrow.
+            groups (ndarray): Replica of each patch, for an ensemble.
+        """
+        self.space = space
+        self.regrowth_time = regrowth_time
+        self.points = np.array(points, dtype=float).reshape(-1, 2)
+        self.points.flags.writeable = False
+        self.fully_grown = np.array(fully_grown, dtype=bool)
+        self.countdown = np.array(countdown, dtype=int)
+        if groups is None:
+            groups = np.zeros(len(self.points), dtype=int)
+        self.groups = np.asarray(groups, dtype=int)
+
+        cx, cy = space._cell_coordinates(self.points)
+        cells = cy * space.n_cells_x + cx
+        self._order = np.argsort(cells, kind='stable')
+        self._counts = np.bincount(
+            cells, minlength=space.n_cells_x * space.n_cells_y)
+        self._starts = np.cumsum(self._counts) - self._counts
+        self._candidates = {}
+
+    def __len__(self):
+        return len(self.points)
+
+    def candidates(self, pos, radius):
+        """Return sorted indices of all patches in cells near a position. """
+        cell = self.space._cell(pos)
+        key = (cell, radius)
+        if key not in self._candidates:
+            cells = self.space._neighborhood(cell, radius)
+            if cells is None:
+                indices = np.arange(len(self))
+            else:
+                indices = np.sort(np.concatenate([np.empty(0, dtype=int)] + [
+                    self._order[self._starts[c]:self._starts[c] + self._counts[c]]
+                    for c in cells]))
+            self._candidates[key] = indices
+        return self._candidates[key]
+
+    def grown_within(self, pos, radius):
+        """Return indices of fully grown patches within radius of a position. """
+        indices = self.candidates(pos, radius)
+        indices = indices[self.fully_grown[indices]]
+        dists = self.space._distances(pos, self.points[indices])
+        return indices[dists <= radius ** 2]
+
+    def heading_to_grown(self, pos, radius):
+        """Return (unnormalized) heading to fully grown patches within radius. """
+        indices = self.grown_within(pos, radius)
+        return self.space.calculate_heading(np.array(pos), self.points[indices])
+
+    def eat(self, index):
+        """Set patch of grass to eaten. """
+        self.fully_grown[index] = False
+
+    def step(self):
+        """Perform a single time step for all grass at once: count down
+        the grass which is not fully grown and regrow it at zero.
+        """
+        growing = ~self.fully_grown
+        regrown = growing & (self.countdown <= 0)
+        self.fully_grown[regrown] = True
+        self.countdown[regrown] = self.regrowth_time
+        self.countdown[growing & ~regrown] -= 1
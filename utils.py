@@ -13,3 +13,45 @@ def move_coordinates(x, y, angle, distance):
 def heading_to_angle(x, y):
     """Return angle based on vector. """
     return math.degrees(math.atan2(x, y))
+
+
+class BlockRandom:
+    """Random number stream which draws its numbers in blocks from a numpy
+    Generator, instead of one Python call per number.
+    Implements the methods of random.Random used by the agents.
+    """
+
+    def __init__(self, rng, block_size=1024):
+        """Create new stream.
+
+        Args:
+            rng (numpy.random.Generator): Generator to draw blocks from.
+            block_size (int): Minimal amount of numbers drawn at once.
+        """
+        self.rng = rng
+        self.block_size = block_size
+        self._block = []
+        self._index = 0
+
+    def refill(self, n=0):
+        """Draw a new block of at least n numbers, discarding the rest of
+        the current block.
+        """
+        self._block = self.rng.random(max(n, self.block_size)).tolist()
+        self._index = 0
+
+    def random(self):
+        """Return random float in [0, 1). """
+        if self._index >= len(self._block):
+            self.refill()
+        value = self._block[self._index]
+        self._index += 1
+        return value
+
+    def uniform(self, a, b):
+        """Return random float in [a, b). """
+        return a + (b - a) * self.random()
+
+    def choice(self, seq):
+        """Return random element of a non-empty sequence. """
+        return seq[int(self.random() * len(seq))]
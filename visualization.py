@@ -20,9 +20,22 @@ class CanvasContinuous(VisualizationElement):
         portrayal_method,
         canvas_width=500,
         canvas_height=500,
+        grass_portrayal_method=None,
+        death_portrayal_method=None,
     ):
-        """Create new canvas. """
+        """Create new canvas.
+
+        Args:
+            portrayal_method: function returning portrayal of an agent.
+            grass_portrayal_method: function returning portrayal of the
+                patch of grass at an index of the grass field.
+            death_portrayal_method: function returning portrayal of a death
+                from the animal type and the steps since the death. Used
+                for models which record deaths in a death buffer.
+        """
         self.portrayal_method = portrayal_method
+        self.grass_portrayal_method = grass_portrayal_method
+        self.death_portrayal_method = death_portrayal_method
         self.canvas_width = canvas_width
         self.canvas_height = canvas_height
 
@@ -35,6 +48,26 @@ class CanvasContinuous(VisualizationElement):
     def render(self, model):
         """Renders model visualization for each time step. """
         space_state = defaultdict(list)
+        if self.grass_portrayal_method is not None:
+            for index, (x, y) in enumerate(model.grass.points):
+                portrayal = self.grass_portrayal_method(model.grass, index)
+                portrayal['x'] = (x - model.space.x_min) / \
+                    (model.space.x_max - model.space.x_min)
+                portrayal['y'] = (y - model.space.y_min) / \
+                    (model.space.y_max - model.space.y_min)
+                space_state[portrayal['Layer']].append(portrayal)
+
+        deaths = getattr(model, 'deaths', None)
+        if self.death_portrayal_method is not None and deaths is not None:
+            steps = model.schedule.steps
+            for (x, y), animal_type, step in deaths.events(since=steps - 10):
+                portrayal = self.death_portrayal_method(animal_type, steps - step)
+                portrayal['x'] = (x - model.space.x_min) / \
+                    (model.space.x_max - model.space.x_min)
+                portrayal['y'] = (y - model.space.y_min) / \
+                    (model.space.y_max - model.space.y_min)
+                space_state[portrayal['Layer']].append(portrayal)
+
         for agent in model.space._agent_to_index:
             portrayal = self.portrayal_method(agent)
             x, y = agent.pos
@@ -0,0 +1,308 @@
+"""
+Runs a batch run on several machines, without an external broker.
+
+Core class: Coordinator
+
+The coordinator serves the runs of a SobolBatchRunner over TCP to workers,
+which can run on other hosts:
+
+    python runner.py --serve 0.0.0.0:6000 --authkey secret
+    python runner.py --worker coordinator-host:6000 --authkey secret
+
+The coordinator listens from its first run until it is closed, so the
+same workers serve every round of an adaptive batch run. Workers get the
+arguments of init_worker at the start of every run.
+
+Every chunk of runs handed to a worker is leased. Workers renew their
+leases while running, and the runs of a lease which expires, or of a worker
+which disconnects, are handed out again. A worker whose tasks raise an
+exception reports it, and the coordinator raises it once the same run has
+failed max_failures times.
+"""
+
+from collections import defaultdict
+from itertools import count
+import threading
+import time
+import traceback
+
+import numpy as np
+
+from multiprocess import Process
+from multiprocess.connection import Client, Listener, wait
+
+from batchrunner import init_worker, run_tasks, task_iterations
+
+
+def parse_address(address):
+    """Returns a (host, port) tuple of an address like 'host:port'. """
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+class Coordinator:
+    """Serves the tasks of a batch run to workers over TCP. """
+
+    def __init__(self, address, authkey, lease_timeout=600, max_failures=3):
+        """Create coordinator, which listens once it is first run, until it
+        is closed.
+
+        Args:
+            address ((str, int)): Host and port to listen on.
+            authkey (bytes): Key which workers need to connect.
+            lease_timeout (float): Seconds after which tasks are handed out
+                again, if the worker did not renew its lease.
+            max_failures (int): Number of times a run may raise an
+                exception on the workers before the batch run fails.
+        """
+        self.address = address
+        self.authkey = authkey
+        self.lease_timeout = lease_timeout
+        self.max_failures = max_failures
+        self._listener = None
+        self._connections = []
+        self._new_connections = []
+        self._lock = threading.Lock()
+        self._lease_ids = count()
+
+    def _accept(self, listener):
+        """Accept workers until the listener is closed. """
+        while True:
+            try:
+                connection = listener.accept()
+            except OSError:
+                return
+            except Exception:
+                # For instance a worker with a wrong authkey.
+                continue
+            with self._lock:
+                self._new_connections.append(connection)
+
+    def listen(self):
+        """Start listening for workers, if not listening yet. """
+        if self._listener is None:
+            self._listener = Listener(self.address, authkey=self.authkey)
+            threading.Thread(target=self._accept, args=(self._listener,),
+                             daemon=True).start()
+
+    def close(self):
+        """Stop listening and tell the workers that the batch run is done,
+        after which they exit.
+        """
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+        with self._lock:
+            self._connections += self._new_connections
+            self._new_connections.clear()
+        for connection in self._connections:
+            try:
+                connection.send(('done',))
+                connection.close()
+            except OSError:
+                pass
+        self._connections.clear()
+
+    def run(self, scheduler, initargs, dtype):
+        """Serve the tasks of scheduler until all of them are done. The
+        workers stay connected for a next run, until close is called.
+
+        Args:
+            scheduler (CostScheduler): Tasks of the batch run.
+            initargs (tuple): Arguments of init_worker, sent to every worker.
+            dtype (np.dtype): Dtype of the result records.
+
+        Yields:
+            The result record of every task, once.
+
+        Raises:
+            RuntimeError: A run failed max_failures times, with the
+                traceback of the last failure.
+        """
+        self.listen()
+        connections = self._connections
+        # Connections which got the initargs of this run.
+        initialized = set()
+        # Lease id to (connection, tasks, deadline).
+        leases = {}
+        # Leases of this run, results of earlier runs are ignored.
+        issued = set()
+        done = set()
+        failures = defaultdict(int)
+        # The parameter values are the second argument of init_worker.
+        rows = len(initargs[1])
+
+        def release(lease_id):
+            """Hand out the tasks of a lease again. """
+            _, tasks, _ = leases.pop(lease_id)
+            for task in tasks:
+                row = task[0]
+                iterations = tuple(iteration for iteration in task_iterations(task)
+                                   if iteration * rows + row not in done)
+                if not iterations:
+                    continue
+                if isinstance(task[1], tuple):
+                    scheduler.requeue(row, iterations[0], (row, iterations))
+                else:
+                    scheduler.requeue(row, iterations[0], task)
+
+        while len(scheduler) or leases:
+            with self._lock:
+                connections += self._new_connections
+                self._new_connections.clear()
+
+            now = time.monotonic()
+            for lease_id in [lease_id for lease_id, (_, _, deadline)
+                             in leases.items() if deadline < now]:
+                release(lease_id)
+
+            for connection in wait(connections, timeout=1):
+                try:
+                    message = connection.recv()
+                except (EOFError, OSError):
+                    connections.remove(connection)
+                    initialized.discard(connection)
+                    for lease_id in [lease_id for lease_id, lease
+                                     in leases.items()
+                                     if lease[0] is connection]:
+                        release(lease_id)
+                    continue
+
+                kind = message[0]
+                if kind == 'hello' or (kind == 'request'
+                                       and connection not in initialized):
+                    # The worker requests tasks again once initialized.
+                    connection.send(('init', initargs, self.lease_timeout))
+                    initialized.add(connection)
+                elif kind == 'request':
+                    if len(scheduler):
+                        lease_id = next(self._lease_ids)
+                        issued.add(lease_id)
+                        tasks = scheduler.next_chunk()
+                        leases[lease_id] = (
+                            connection, tasks,
+                            time.monotonic() + self.lease_timeout)
+                        connection.send(('tasks', lease_id, tasks))
+                    else:
+                        # Tasks of other workers may still be released.
+                        connection.send(('wait', 1))
+                elif kind == 'renew':
+                    lease_id = message[1]
+                    if lease_id in leases:
+                        connection_, tasks, _ = leases[lease_id]
+                        leases[lease_id] = (
+                            connection_, tasks,
+                            time.monotonic() + self.lease_timeout)
+                elif kind == 'error':
+                    _, lease_id, trace = message
+                    if lease_id not in leases:
+                        continue
+                    tasks = leases[lease_id][1]
+                    release(lease_id)
+                    for task in tasks:
+                        for iteration in task_iterations(task):
+                            run = iteration * rows + task[0]
+                            failures[run] += 1
+                            if failures[run] >= self.max_failures:
+                                raise RuntimeError(
+                                    f'Run {run} failed {failures[run]} times '
+                                    f'on the workers, last with:\n{trace}')
+                elif kind == 'result':
+                    _, lease_id, result = message
+                    if lease_id not in issued:
+                        continue
+                    leases.pop(lease_id, None)
+                    for record in np.frombuffer(result, dtype=dtype):
+                        # A released task may be finished twice.
+                        run = int(record['run'])
+                        if run not in done:
+                            done.add(run)
+                            yield record
+
+
+def connect(address, authkey, timeout=600):
+    """Connect to a coordinator. Workers may start before the coordinator
+    listens, so refused connections are retried with increasing delays
+    until timeout seconds have passed.
+    """
+    deadline = time.monotonic() + timeout
+    delay = 0.1
+    while True:
+        try:
+            return Client(address, authkey=authkey)
+        except ConnectionRefusedError:
+            if time.monotonic() + delay > deadline:
+                raise
+            time.sleep(delay)
+            delay = min(2 * delay, 5)
+
+
+def run_worker(address, authkey, connect_timeout=600):
+    """Connect to a coordinator and run its tasks until the batch run is
+    done. The lease of the running tasks is renewed in a separate thread.
+    """
+    connection = connect(address, authkey, connect_timeout)
+    lock = threading.Lock()
+    current = [None]
+    stopped = threading.Event()
+
+    def renew(lease_timeout):
+        """Renew the lease of the running tasks. """
+        while not stopped.wait(lease_timeout / 3):
+            with lock:
+                if current[0] is not None:
+                    try:
+                        connection.send(('renew', current[0]))
+                    except OSError:
+                        # The coordinator is gone.
+                        return
+
+    renewer = None
+    try:
+        connection.send(('hello',))
+        while True:
+            message = connection.recv()
+            if message[0] == 'done':
+                break
+            elif message[0] == 'init':
+                # Sent before the first tasks of every run of the coordinator.
+                _, initargs, lease_timeout = message
+                init_worker(*initargs)
+                if renewer is None:
+                    renewer = threading.Thread(target=renew,
+                                               args=(lease_timeout,),
+                                               daemon=True)
+                    renewer.start()
+            elif message[0] == 'wait':
+                time.sleep(message[1])
+            else:
+                _, lease_id, tasks = message
+                current[0] = lease_id
+                try:
+                    reply = ('result', lease_id, run_tasks(tasks))
+                except Exception:
+                    # Report the error and go on, the coordinator decides
+                    # whether to retry the tasks.
+                    reply = ('error', lease_id, traceback.format_exc())
+                with lock:
+                    current[0] = None
+                    connection.send(reply)
+            with lock:
+                connection.send(('request',))
+    except (EOFError, OSError):
+        # The coordinator is gone.
+        pass
+    finally:
+        stopped.set()
+        connection.close()
+
+
+def run_workers(address, authkey, processes, connect_timeout=600):
+    """Run several workers in separate processes and wait for them. """
+    workers = [Process(target=run_worker,
+                       args=(address, authkey, connect_timeout))
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()